@@ -0,0 +1,117 @@
+import json
+import os
+import hashlib
+
+# Characters read from the file per chunk while parsing
+CHUNK_SIZE = 1 << 20
+
+_decoder = json.JSONDecoder()
+# Characters that can continue a number, so a number ending right before one of them at the end of
+# a chunk may not be complete
+_NUMBER_CHARS = frozenset('0123456789.eE+-')
+
+def iter_records(path, chunk_size=CHUNK_SIZE):
+    """
+    Stream the records of a JSON array file or a JSONL file one at a time,
+    without loading the whole file or keeping the parsed list in memory.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer = ''
+        pos = 0
+        eof = False
+        in_array = None
+
+        def refill():
+            # Drop the consumed part of the buffer and append the next chunk
+            nonlocal buffer, pos, eof
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+        while True:
+            separators = ' \t\r\n,' if in_array else ' \t\r\n'
+            while pos < len(buffer) and buffer[pos] in separators:
+                pos += 1
+            if pos == len(buffer):
+                if eof:
+                    if in_array:
+                        raise ValueError(f"{path}: unterminated JSON array")
+                    return
+                refill()
+                continue
+
+            if in_array is None:
+                # A leading '[' is a JSON array, anything else a stream of JSON values (JSONL)
+                in_array = buffer[pos] == '['
+                pos += in_array
+                continue
+            if in_array and buffer[pos] == ']':
+                return
+
+            try:
+                record, end = _decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                refill()
+                continue
+            if not eof and (end == len(buffer) or (
+                    isinstance(record, (int, float)) and not isinstance(record, bool)
+                    and buffer[end] in _NUMBER_CHARS)):
+                # The value may continue in the next chunk
+                refill()
+                continue
+            pos = end
+            yield record
+
+def load_records(path):
+    """
+    Load all records of a JSON array or JSONL file into a list
+    """
+    return list(iter_records(path))
+
+def hash_file(path, algorithm='sha256'):
+    """
+    Hex digest of the content of a file, read in chunks
+    """
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def ends_with_newline(path):
+    """
+    Whether the last line of a file is complete; a missing or empty file counts as complete
+    """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return True
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+def open_records_file(path, append):
+    """
+    Open a JSONL file to append records to (or to write from scratch when append is false),
+    terminating a last line left incomplete by an interruption
+    """
+    needs_newline = append and not ends_with_newline(path)
+    f = open(path, 'a' if append else 'w', encoding='utf-8')
+    if needs_newline:
+        f.write('\n')
+    return f
+
+def _generate_records(path, signature):
+    # signature is only there so that the datasets cache is invalidated when the file changes
+    yield from iter_records(path)
+
+def load_dataset(path, **kwargs):
+    """
+    Build a datasets.Dataset from a JSON array or JSONL file by streaming its records
+    """
+    from datasets import Dataset
+
+    stat = os.stat(path)
+    signature = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    return Dataset.from_generator(_generate_records, gen_kwargs={"path": path, "signature": signature}, **kwargs)
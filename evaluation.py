@@ -2,140 +2,194 @@ import json
 import sqlite3
 import re
 import os
+import hashlib
+import pickle
+import zlib
+import time
+import argparse
+import warnings
+import threading
 import multiprocessing as mp
-from func_timeout import func_timeout, FunctionTimedOut
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from data_loader import hash_file, open_records_file
+
+# Maximum number of databases kept open per worker process
+DB_CACHE_SIZE = 32
+# On-disk cache of ground-truth results, shared across runs and checkpoints (None disables it)
+GT_CACHE_PATH = "gt_cache.sqlite"
+# Directory holding one sub-directory per db_id
+DB_ROOT = "database"
+# Manifest caching the db_id index of DB_ROOT, written to the working directory by the command line
+DB_INDEX_FILE = ".db_index.json"
+# Append-only JSONL file receiving execution results as they complete, used to resume interrupted runs
+EXEC_RESULTS_PATH = "exec_results.jsonl"
+# Per-sample metric columns of the evaluation table; data_acc and all_acc are NaN for samples that were not executed
+METRIC_COLUMNS = ['chart_acc', 'axis_acc', 'sql_acc', 'bin_acc', 'text_data_acc', 'text_all_acc', 'data_acc', 'all_acc']
+TABLE_COLUMNS = ['sample_idx', 'db_id', 'chart_type', 'has_bin'] + METRIC_COLUMNS
+# Number of SQLite VM instructions between two deadline checks
+PROGRESS_HANDLER_STEPS = 1000
+# Rows fetched at a time when results are streamed
+FETCH_SIZE = 1000
+# 'sorted' compares fully fetched, sorted result sets; 'hash' streams rows into a count and
+# multiset digest, stopping a prediction once it returns more rows than the ground truth
+COMPARE_MODES = ('sorted', 'hash')
+MULTISET_MODULUS = 1 << 128
+
+class SQLTimeout(Exception):
+    """
+    Raised when a query is interrupted because it ran past its deadline
+    """
+
+# Start of a VQL statement inside a model response
+_VQL_START_PATTERN = re.compile(r'Visualize\s+[A-Z]+\s+SELECT', re.IGNORECASE)
+_FINAL_VQL_PATTERN = re.compile(r'Final VQL:', re.IGNORECASE)
+# VISUALIZE [TYPE] [SQL] [BIN ...], the SQL body stops at the first BIN keyword
+_VQL_CLAUSE_PATTERN = re.compile(r'VISUALIZE\s+(\S+)\s*(.*?)\s*(\bBIN\b.*)?', re.IGNORECASE | re.DOTALL)
+_SQL_BIN_PATTERN = re.compile(r'\bBIN\b', re.IGNORECASE)
+_SELECT_CLAUSE_PATTERN = re.compile(r'SELECT\s+(.*?)(?:\s+FROM\b.*)?', re.IGNORECASE | re.DOTALL)
+_SPACE_BEFORE_COMMA_PATTERN = re.compile(r' (?=,)')
+# Trailing alias of a SELECT expression: "AS alias", or a bare alias after a closing parenthesis
+_SELECT_ALIAS_PATTERN = re.compile(r"""\s+AS\s+(?:"[^"]*"|'[^']*'|`[^`]*`|\S+)$|(?<=\))\s*[A-Za-z_][A-Za-z0-9_]*$""",
+                                   re.IGNORECASE)
+_ORDER_BY_PATTERN = re.compile(r'\bORDER\s+BY\b', re.IGNORECASE)
+
+# Clause-level parse of a VQL statement:
+# chart_type is the upper-cased VISUALIZE type (None without a VISUALIZE prefix),
+# body is everything after the chart type, sql is the upper-cased SQL part without BIN,
+# bin is the BIN clause (None if absent) and select_columns the lower-cased SELECT expressions
+VQL = namedtuple('VQL', ['text', 'chart_type', 'body', 'sql', 'bin', 'select_columns'])
 
 def extract_last_vql_1(text):
     """
     Extract the last occurrence of Visualize and subsequent content as VQL from text
     """
-    try:
-        # Define regex to precisely match VQL statements starting with Visualize
-        vql_pattern = re.compile(r'(Visualize\s+[A-Z]+\s+SELECT.*)', re.IGNORECASE | re.DOTALL)
-        matches = vql_pattern.findall(text)
-        if matches:
-            last_vql = matches[-1].strip()
-            # Remove possible extra quotes and newlines
-            last_vql = last_vql.replace('\n', ' ').replace('"', '').strip()
-            return last_vql
-        return None
-    except Exception as e:
-        print(f"Error extracting VQL: {e}")
+    last_match = None
+    for last_match in _VQL_START_PATTERN.finditer(text):
+        pass
+    if last_match is None:
         return None
+    # Remove possible extra quotes and newlines
+    return text[last_match.start():].replace('\n', ' ').replace('"', '').strip()
 
 def extract_last_vql(text):
     """
     Extract the last occurrence of VQL statement from text
     """
-    vql_pattern = re.compile(r'Final VQL:(.*)', re.IGNORECASE | re.DOTALL)
-    matches = vql_pattern.findall(text)
-    if matches:
-        last_vql = matches[-1].strip()
-        # Remove possible extra quotes and newlines
-        last_vql = last_vql.replace('\n', ' ').replace('"', '').strip()
-        return last_vql
-    return None
+    last_match = None
+    for last_match in _FINAL_VQL_PATTERN.finditer(text):
+        pass
+    if last_match is None:
+        return None
+    # Remove possible extra quotes and newlines
+    return text[last_match.end():].replace('\n', ' ').replace('"', '').strip()
+
+def split_select_columns(sql):
+    """
+    Split the SELECT clause of sql into lower-cased column expressions, ignoring commas inside parentheses.
+    Aliases are dropped, so that they do not count against a column, as when only the first token was compared.
+    """
+    match = _SELECT_CLAUSE_PATTERN.fullmatch(sql.strip())
+    if match is None:
+        return ()
+    columns = []
+    depth = 0
+    current = []
+    for char in match.group(1):
+        if char == ',' and depth == 0:
+            columns.append(''.join(current))
+            current = []
+            continue
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        current.append(char)
+    columns.append(''.join(current))
+    return tuple(_SELECT_ALIAS_PATTERN.sub('', ' '.join(col.split())).lower() for col in columns)
+
+@lru_cache(maxsize=100000)
+def parse_vql(vql):
+    """
+    Parse a VQL statement into its clauses in a single pass
+    """
+    text = vql.strip()
+    match = _VQL_CLAUSE_PATTERN.fullmatch(text)
+    if match is not None:
+        chart_type = match.group(1).upper()
+        body = text[match.end(1):].strip()
+        sql, bin_clause = match.group(2), match.group(3)
+    else:
+        chart_type = None
+        body = text
+        bin_match = _SQL_BIN_PATTERN.search(text)
+        sql = text[:bin_match.start()].strip() if bin_match else text
+        bin_clause = text[bin_match.start():] if bin_match else None
+    sql = sql.upper()
+    return VQL(text, chart_type, body, sql, bin_clause.strip() if bin_clause else None, split_select_columns(sql))
 
 def extract_vis(vql):
     """
     Extract VISUALIZE field from VQL
     """
-    vql = vql.upper()
-    parts = vql.split()
-    if len(parts) > 1 and parts[0].upper() == 'VISUALIZE':
-        return parts[1].upper()
-    return None
+    return parse_vql(vql).chart_type
 
 def remove_space_before_comma(sql):
-    result = ""
-    for i, char in enumerate(sql):
-        if char == ' ' and i > 0 and sql[i + 1] == ',':
-            continue
-        result += char
-    return result
+    return _SPACE_BEFORE_COMMA_PATTERN.sub('', sql)
 
 def extract_sql(vql):
     """
     Extract SQL part from VQL
     """
-    # Remove VISUALIZE part
-    vql = vql.upper()
-    vis = extract_vis(vql)
-    if vis:
-        vql = vql.replace(f"VISUALIZE {vis}", "").strip()
-    # Check if contains BIN BY
-    bin_by_index = vql.find('BIN')
-    if bin_by_index != -1:
-        return vql[:bin_by_index].strip()
-    return vql.strip()
+    return parse_vql(vql).sql
 
 def extract_bin(vql):
     """
     Extract BIN part from VQL
     """
-    bin_by_index = vql.find('BIN')
-    if bin_by_index != -1:
-        return vql[bin_by_index:].strip()
-    return None
+    return parse_vql(vql).bin
 
 def extract_select_columns(sql):
     """
     Extract column names from SELECT fields in SQL
     """
-    if sql.startswith('SELECT'):
-        select_part = sql[len('SELECT'):].strip()
-        columns = select_part.split(',')
-        columns = [col.strip().split(' ')[0].lower() for col in columns]  # Convert column names to lowercase
-        return columns
-    return []
+    return list(split_select_columns(sql))
 
 def evaluate_accuracy(response_vql, groundtruth_vql):
     """
     Evaluate accuracy of response VQL against ground truth VQL for each part
     """
-    # Extract VISUALIZE field
-    response_vis = extract_vis(response_vql)
-    groundtruth_vis = extract_vis(groundtruth_vql)
-    vis_accuracy = response_vis == groundtruth_vis
-    
-    # Extract SQL part
-    response_sql = extract_sql(response_vql)
-    groundtruth_sql_1 = extract_sql(groundtruth_vql)
-    groundtruth_sql = remove_space_before_comma(groundtruth_sql_1)
-    
+    response = parse_vql(response_vql)
+    groundtruth = parse_vql(groundtruth_vql)
+
+    # Compare VISUALIZE field
+    vis_accuracy = response.chart_type == groundtruth.chart_type
+
     # Case-insensitive comparison of SQL statements
-    sql_accuracy = 1 if response_sql is not None and groundtruth_sql is not None and response_sql.lower() == groundtruth_sql.lower() else 0
+    sql_accuracy = 1 if response.sql.lower() == remove_space_before_comma(groundtruth.sql).lower() else 0
 
-    # Extract BIN part
-    response_bin = extract_bin(response_vql)
-    groundtruth_bin = extract_bin(groundtruth_vql)
-    
     # Case-insensitive comparison of BIN part, check for None first
-    if response_bin is None and groundtruth_bin is None:
+    if response.bin is None and groundtruth.bin is None:
         bin_accuracy = 1
-    elif response_bin is None or groundtruth_bin is None:
+    elif response.bin is None or groundtruth.bin is None:
         bin_accuracy = 0
     else:
-        bin_accuracy = 1 if response_bin.lower() == groundtruth_bin.lower() else 0
-
-    # Extract SELECT columns
-    response_columns = extract_select_columns(response_sql)
-    groundtruth_columns = extract_select_columns(groundtruth_sql)
+        bin_accuracy = 1 if response.bin.lower() == groundtruth.bin.lower() else 0
 
     # Calculate SELECT field column name accuracy
+    response_columns = response.select_columns
+    groundtruth_columns = split_select_columns(remove_space_before_comma(groundtruth.sql))
     if len(groundtruth_columns) == 0:
         select_columns_accuracy = 1 if len(response_columns) == 0 else 0
     else:
         correct_count = sum(col in response_columns for col in groundtruth_columns)
         select_columns_accuracy = correct_count / len(groundtruth_columns)
 
-    # Remove VISUALIZE part
-    response_without_vis = response_vql.replace(f"Visualize {response_vis}", "").strip().lower() if response_vis else response_vql.strip().lower()
-    groundtruth_without_vis_1 = groundtruth_vql.replace(f"Visualize {groundtruth_vis}", "").strip().lower() if groundtruth_vis else groundtruth_vql.strip().lower()
-    groundtruth_without_vis = remove_space_before_comma(groundtruth_without_vis_1)
-    
     # Case-insensitive comparison of part after removing VISUALIZE
-    data_accuracy = 1 if response_without_vis == groundtruth_without_vis else 0
+    data_accuracy = 1 if response.body.lower() == remove_space_before_comma(groundtruth.body).lower() else 0
 
     # Overall accuracy: all_accuracy is 1 when both vis and data are correct
     all_accuracy = 1 if vis_accuracy and data_accuracy else 0
@@ -175,35 +229,291 @@ def get_table_and_column_names(conn):
         print(f"Error getting table and column names: {e}")
     return table_names, column_names
 
-def standardize_sql(sql, table_names, column_names):
-    # Match letter plus underscore combinations that might be wrapped in quotes
-    word_pattern = r'(["\']?[a-zA-Z_]+["\']?)'
-    words = re.findall(word_pattern, sql)
-    for word in words:
-        stripped_word = word.strip('"\'')
-        for table_name in table_names:
-            if stripped_word.lower() == table_name.lower():
-                replacement = word.replace(stripped_word, table_name)
-                sql = sql.replace(word, replacement)
-        for columns in column_names.values():
-            for column in columns:
-                if stripped_word.lower() == column.lower():
-                    replacement = word.replace(stripped_word, column)
-                    sql = sql.replace(word, replacement)
-    return sql
-
-def execute_sql(predicted_sql, ground_truth, db_path, db_id):
-    conn = sqlite3.connect(db_path)
+# Worker-local cache of read-only connections and schema catalogs, keyed by db_path
+_db_cache = OrderedDict()
+_db_cache_pid = None
+
+def open_readonly_connection(db_path):
+    """
+    Open a read-only SQLite connection to db_path
+    """
+    uri = Path(db_path).resolve().as_uri() + "?mode=ro"
+    return sqlite3.connect(uri, uri=True)
+
+def get_db(db_path):
+    """
+    Return the cached connection and table/column catalog for db_path, opening it on first use
+    """
+    global _db_cache_pid
+    # Connections inherited from a parent process through fork must not be reused
+    if _db_cache_pid != os.getpid():
+        _db_cache.clear()
+        _db_cache_pid = os.getpid()
+    entry = _db_cache.get(db_path)
+    if entry is not None:
+        _db_cache.move_to_end(db_path)
+        return entry
+    conn = open_readonly_connection(db_path)
+    table_names, column_names = get_table_and_column_names(conn)
+    entry = {'conn': conn, 'table_names': table_names, 'column_names': column_names,
+             'lookup': build_identifier_lookup(table_names, column_names), 'hash': cached_hash_file(db_path),
+             'deadline': None, 'timed_out': False}
+
+    def check_deadline():
+        # A non-zero return value makes SQLite abort the running statement
+        if entry['deadline'] is not None and time.monotonic() > entry['deadline']:
+            entry['timed_out'] = True
+            return 1
+        return 0
+
+    conn.set_progress_handler(check_deadline, PROGRESS_HANDLER_STEPS)
+    _db_cache[db_path] = entry
+    while len(_db_cache) > DB_CACHE_SIZE:
+        _, evicted = _db_cache.popitem(last=False)
+        evicted['conn'].close()
+    return entry
+
+# SHA-1 of the database files already hashed by this process, keyed by path, with the size and
+# modification time they were computed for; forked workers inherit it
+_file_hash_cache = {}
+
+def cached_hash_file(path):
+    """
+    SHA-1 of a file, computed again only when its size or modification time changed
+    """
+    stat = os.stat(path)
+    cached = _file_hash_cache.get(path)
+    if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+        return cached[2]
+    digest = hash_file(path, 'sha1')
+    _file_hash_cache[path] = (stat.st_size, stat.st_mtime_ns, digest)
+    return digest
+
+# Worker-local handle on the ground-truth result cache
+_gt_cache_path = GT_CACHE_PATH
+_gt_cache_conn = None
+_gt_cache_pid = None
+# Worker-local cap on the number of rows fetched for a predicted SQL (None means no cap)
+_max_rows = None
+# Worker-local result comparison settings, see COMPARE_MODES
+_compare_mode = 'sorted'
+_order_sensitive = False
+# Worker-local queue each result is sent to as soon as it completes (None when results are not streamed)
+_result_queue = None
+
+def init_worker(gt_cache_path, max_rows=None, compare_mode='sorted', order_sensitive=False, result_queue=None):
+    """
+    Pool initializer: configure the ground-truth cache location, row cap, comparison mode and result queue
+    in each worker
+    """
+    global _gt_cache_path, _gt_cache_conn, _max_rows, _compare_mode, _order_sensitive, _result_queue
+    _gt_cache_path = gt_cache_path
+    _gt_cache_conn = None
+    _max_rows = max_rows
+    _compare_mode = compare_mode
+    _order_sensitive = order_sensitive
+    _result_queue = result_queue
+
+def get_gt_cache():
+    """
+    Return a connection to the ground-truth result cache, or None if it is disabled
+    """
+    global _gt_cache_conn, _gt_cache_pid
+    if _gt_cache_path is None:
+        return None
+    if _gt_cache_conn is None or _gt_cache_pid != os.getpid():
+        conn = sqlite3.connect(_gt_cache_path, timeout=60)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, result BLOB)")
+        conn.commit()
+        _gt_cache_conn = conn
+        _gt_cache_pid = os.getpid()
+    return _gt_cache_conn
+
+_WHITESPACE_OUTSIDE_QUOTES = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")|\s+""")
+
+def normalize_sql(sql):
+    """
+    Collapse whitespace outside quoted literals so formatting differences do not produce distinct keys
+    """
+    return _WHITESPACE_OUTSIDE_QUOTES.sub(lambda m: m.group(1) or ' ', sql).strip()
+
+def run_query(entry, cursor, sql, time_out, consume):
+    """
+    Execute sql on the connection of entry and return consume(cursor).
+    The statement is interrupted by the progress handler once time_out seconds have passed.
+    """
+    entry['deadline'] = time.monotonic() + time_out if time_out else None
+    entry['timed_out'] = False
+    try:
+        cursor.execute(sql)
+        return consume(cursor)
+    except sqlite3.OperationalError as e:
+        if entry['timed_out']:
+            raise SQLTimeout(f"Query exceeded {time_out} seconds") from e
+        raise
+    finally:
+        entry['deadline'] = None
+
+def fetch_sorted_result(entry, cursor, sql, time_out=None, max_rows=None):
+    """
+    Execute sql and return its sorted result set.
+    Fetching stops as soon as more than max_rows rows are returned.
+    """
+    def consume(cursor):
+        if max_rows is None:
+            return sorted(cursor.fetchall())
+        rows = []
+        while True:
+            chunk = cursor.fetchmany(FETCH_SIZE)
+            if not chunk:
+                break
+            rows.extend(chunk)
+            if len(rows) > max_rows:
+                raise RuntimeError(f"Result exceeds {max_rows} rows")
+        return sorted(rows)
+
+    return run_query(entry, cursor, sql, time_out, consume)
+
+def row_digest(row):
+    # Integral floats are hashed as ints so that 3.0 matches 3, as with tuple equality
+    key = repr(tuple(int(value) if isinstance(value, float) and value.is_integer() else value for value in row))
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+
+def summarize_result(entry, cursor, sql, time_out=None, max_rows=None, stop_after=None):
+    """
+    Execute sql and stream its rows into a summary instead of materializing them: the row count,
+    an order-independent digest (sum of row digests) and an order-dependent digest.
+    Fetching stops once more than stop_after rows were seen, and the summary is then marked truncated.
+    """
+    def consume(cursor):
+        count = 0
+        multiset = 0
+        ordered = hashlib.blake2b(digest_size=16)
+        truncated = False
+        while True:
+            chunk = cursor.fetchmany(FETCH_SIZE)
+            if not chunk:
+                break
+            for row in chunk:
+                digest = row_digest(row)
+                multiset = (multiset + int.from_bytes(digest, 'big')) % MULTISET_MODULUS
+                ordered.update(digest)
+            count += len(chunk)
+            if max_rows is not None and count > max_rows:
+                raise RuntimeError(f"Result exceeds {max_rows} rows")
+            if stop_after is not None and count > stop_after:
+                truncated = True
+                break
+        return {'count': count, 'multiset': multiset, 'ordered': ordered.digest(), 'truncated': truncated}
+
+    return run_query(entry, cursor, sql, time_out, consume)
+
+def compare_summaries(predicted, ground_truth, ordered=False):
+    # A truncated prediction has more rows than the ground truth it was fetched against
+    if predicted['count'] != ground_truth['count']:
+        return 0
+    key = 'ordered' if ordered else 'multiset'
+    return 1 if predicted[key] == ground_truth[key] else 0
+
+def get_ground_truth_result(entry, cursor, ground_truth, time_out=None):
+    """
+    Return the sorted result set of the ground-truth SQL, or its summary in 'hash' compare mode,
+    reading it from the cache when possible
+    """
+    if _compare_mode == 'hash':
+        compute = lambda: summarize_result(entry, cursor, ground_truth, time_out)
+        key_prefix = "hash:"
+    else:
+        compute = lambda: fetch_sorted_result(entry, cursor, ground_truth, time_out)
+        key_prefix = ""
+    cache = get_gt_cache()
+    if cache is None:
+        return compute()
+    key = f"{key_prefix}{entry['hash']}:{normalize_sql(ground_truth)}"
+    row = cache.execute("SELECT result FROM results WHERE key=?", (key,)).fetchone()
+    if row is not None:
+        return pickle.loads(zlib.decompress(row[0]))
+    result = compute()
+    cache.execute("INSERT OR IGNORE INTO results (key, result) VALUES (?, ?)",
+                  (key, zlib.compress(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))))
+    cache.commit()
+    return result
+
+def get_predicted_result(memo, memo_key, compute, is_stale=None):
+    """
+    Return the memoized result of a predicted SQL, computing it when missing or stale.
+    Exceptions are memoized as well, and raised for every sample sharing the query;
+    is_stale is only asked about results, never about a memoized exception.
+    """
+    cached = memo is not None and memo_key in memo
+    if cached and is_stale is not None and not isinstance(memo[memo_key], Exception):
+        cached = not is_stale(memo[memo_key])
+    if cached:
+        result = memo[memo_key]
+    else:
+        try:
+            result = compute()
+        except Exception as e:
+            result = e
+        if memo is not None:
+            memo[memo_key] = result
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+# Single-quoted literals, quoted identifiers and bare words, matched in one left-to-right pass
+_SQL_TOKEN_PATTERN = re.compile(r"""('(?:[^']|'')*')|(["`])([^"`]*)\2|([A-Za-z_][A-Za-z0-9_]*)""")
+
+def build_identifier_lookup(table_names, column_names):
+    """
+    Map lowercase table and column names to their spelling in the database, tables taking precedence
+    """
+    lookup = {}
+    for columns in column_names.values():
+        for column in columns:
+            lookup.setdefault(column.lower(), column)
+    for table_name in table_names:
+        lookup[table_name.lower()] = table_name
+    return lookup
+
+def standardize_sql(sql, table_names, column_names, lookup=None):
+    """
+    Rewrite table and column names in sql with the case used in the database.
+    String literals are left untouched.
+    """
+    if lookup is None:
+        lookup = build_identifier_lookup(table_names, column_names)
+
+    def replace(match):
+        if match.group(1) is not None:
+            return match.group(0)
+        if match.group(2) is not None:
+            name = lookup.get(match.group(3).lower())
+            return f"{match.group(2)}{name}{match.group(2)}" if name is not None else match.group(0)
+        return lookup.get(match.group(4).lower(), match.group(4))
+
+    return _SQL_TOKEN_PATTERN.sub(replace, sql)
+
+def canonicalize_sql(sql, table_names, column_names, lookup=None):
+    """
+    Canonical form of a SQL statement used to detect duplicate predictions on a database
+    """
+    return normalize_sql(standardize_sql(sql, table_names, column_names, lookup))
+
+def execute_sql(predicted_sql, ground_truth, db_path, db_id, memo=None, time_out=None):
+    entry = get_db(db_path)
+    conn = entry['conn']
     cursor = conn.cursor()
     empty_db_ids = []
     skipped = False
     skipped_info = {}
     try:
         # Get table and column names
-        table_names, column_names = get_table_and_column_names(conn)
+        table_names, column_names = entry['table_names'], entry['column_names']
         # Standardize SQL statements
-        predicted_sql = standardize_sql(predicted_sql, table_names, column_names)
-        ground_truth = standardize_sql(ground_truth, table_names, column_names)
+        predicted_sql = standardize_sql(predicted_sql, table_names, column_names, entry['lookup'])
+        ground_truth = standardize_sql(ground_truth, table_names, column_names, entry['lookup'])
 
         # Try to extract table name (considering quotes), optimize regex
         table_name_match = re.search(r'\bFROM\s+(["\']?[a-zA-Z_]+["\']?)(?:\s+AS\s+["\']?[a-zA-Z_]+["\']?)?',
@@ -227,16 +537,27 @@ def execute_sql(predicted_sql, ground_truth, db_path, db_id):
                 }
                 return 0, empty_db_ids, skipped, skipped_info
 
-        cursor.execute(predicted_sql)
-        predicted_res = cursor.fetchall()
-        cursor.execute(ground_truth)
-        ground_truth_res = cursor.fetchall()
+        # A predicted SQL already run in this batch is not executed again,
+        # and the ground truth comes from the result cache when available
+        memo_key = (db_path, predicted_sql)
+        if _compare_mode == 'hash':
+            # Stream the prediction against the ground-truth cardinality, so oversized results stop early
+            ground_truth_res = get_ground_truth_result(entry, cursor, ground_truth, time_out)
+            predicted_res = get_predicted_result(
+                memo, memo_key,
+                lambda: summarize_result(entry, cursor, predicted_sql, time_out, _max_rows, ground_truth_res['count']),
+                lambda res: res['truncated'] and res['count'] <= ground_truth_res['count'])
+            ordered = _order_sensitive and _ORDER_BY_PATTERN.search(ground_truth) is not None
+            return compare_summaries(predicted_res, ground_truth_res, ordered), empty_db_ids, skipped, skipped_info
 
         # Sort result sets
-        predicted_res = sorted(predicted_res)
-        ground_truth_res = sorted(ground_truth_res)
+        predicted_res = get_predicted_result(
+            memo, memo_key, lambda: fetch_sorted_result(entry, cursor, predicted_sql, time_out, _max_rows))
+        ground_truth_res = get_ground_truth_result(entry, cursor, ground_truth, time_out)
 
         return 1 if predicted_res == ground_truth_res else 0, empty_db_ids, skipped, skipped_info
+    except SQLTimeout:
+        raise
     except Exception as e:
         print(f"------------------------------")
         print(f"Error executing SQL:")
@@ -253,12 +574,12 @@ def execute_sql(predicted_sql, ground_truth, db_path, db_id):
         }
         return 0, empty_db_ids, skipped, skipped_info
     finally:
-        conn.close()
+        cursor.close()
 
-def execute_model(predicted_sql, ground_truth, predicted_vis, ground_truth_vis, predicted_bin_by, ground_truth_bin_by, db_place, idx, meta_time_out, db_id):
+def execute_model(predicted_sql, ground_truth, predicted_vis, ground_truth_vis, predicted_bin_by, ground_truth_bin_by, db_place, idx, meta_time_out, db_id, memo=None):
     try:
-        sql_res, empty_db_ids, skipped, skipped_info = func_timeout(meta_time_out, execute_sql,
-                                                                args=(predicted_sql, ground_truth, db_place, db_id))
+        sql_res, empty_db_ids, skipped, skipped_info = execute_sql(predicted_sql, ground_truth, db_place, db_id,
+                                                                   memo, meta_time_out)
         vis_res = 1 if predicted_vis == ground_truth_vis else 0
         bin_res = 1 if predicted_bin_by == ground_truth_bin_by else 0
         all_res = 1 if sql_res == 1 and vis_res == 1 and bin_res == 1 else 0
@@ -266,7 +587,7 @@ def execute_model(predicted_sql, ground_truth, predicted_vis, ground_truth_vis,
     except KeyboardInterrupt:
         import sys
         sys.exit(0)
-    except FunctionTimedOut:
+    except SQLTimeout:
         print(f"------------------------------")
         print(f"SQL execution timeout:")
         print(f"db_id: {db_id}")
@@ -309,24 +630,161 @@ def execute_model(predicted_sql, ground_truth, predicted_vis, ground_truth_vis,
         }
     return {'sql_idx': idx, 'sql_res': sql_res, 'vis_res': vis_res, 'bin_res': bin_res, 'all_res': all_res, 'bin_sql_res': bin_sql_res, 'empty_db_ids': empty_db_ids, 'skipped': skipped, 'skipped_info': skipped_info}
 
-def run_sqls_parallel(sqls, vis_pairs, bin_by_pairs, db_places, db_ids, num_cpus=1, meta_time_out=30.0):
-    exec_result = []
-    pool = mp.Pool(processes=num_cpus)
+def execute_batch(batch):
+    """
+    Run a batch of tasks in one worker round-trip, executing each distinct predicted SQL once.
+    Each result is also sent to the result queue as soon as it completes.
+    """
+    memo = {}
+    results = []
+    for task in batch:
+        result = execute_model(*task, memo=memo)
+        if _result_queue is not None:
+            _result_queue.put(result)
+        results.append(result)
+    return results
+
+def write_results(result_queue, results_file):
+    """
+    Append the results received from the workers to results_file as JSON lines, until None is received
+    """
+    for result in iter(result_queue.get, None):
+        results_file.write(json.dumps(result) + "\n")
+        results_file.flush()
+
+def dedup_tasks(tasks):
+    """
+    Group tasks sharing the same (db_id, canonical predicted SQL) into units.
+    The predicted SQL of each task is replaced by its canonical form. Tasks are grouped by database first,
+    so each catalog is read once, without going through the worker connection cache of get_db.
+    """
+    tasks_by_db = {}
+    for task in tasks:
+        tasks_by_db.setdefault(task[6], []).append(task)
+    units = {}
+    for db_place, db_tasks in tasks_by_db.items():
+        conn = open_readonly_connection(db_place)
+        try:
+            table_names, column_names = get_table_and_column_names(conn)
+        finally:
+            conn.close()
+        lookup = build_identifier_lookup(table_names, column_names)
+        for task in db_tasks:
+            predicted_sql = canonicalize_sql(task[0], table_names, column_names, lookup)
+            units.setdefault((task[9], predicted_sql), []).append((predicted_sql,) + task[1:])
+    if tasks:
+        print(f"Unique predicted SQL: {len(units)}/{len(tasks)} (dedup ratio {1 - len(units) / len(tasks):.2%})")
+    return list(units.values())
+
+def group_units_by_db(units):
+    """
+    Partition units into one batch per database, most expensive first.
+    The cost of a database is estimated by its number of distinct predicted SQL, so dispatching
+    batches in this order to idle workers gives a longest-processing-time schedule.
+    """
+    groups = {}
+    for unit in units:
+        # unit[0][6] is db_place, see execute_model
+        groups.setdefault(unit[0][6], []).append(unit)
+    batches = sorted(groups.values(), key=len, reverse=True)
+    return [[task for unit in batch for task in unit] for batch in batches]
+
+def load_exec_results(results_path, fingerprint):
+    """
+    Read the results already streamed to results_path by a run over the same tasks.
+    A file written for other tasks is ignored, and so are lines truncated by an interruption.
+    """
+    done = {}
+    if results_path is None or not os.path.exists(results_path):
+        return done
+    with open(results_path, 'r') as f:
+        lines = f.readlines()
+    if not lines:
+        return done
+    try:
+        header = json.loads(lines[0])
+    except ValueError:
+        header = {}
+    if header.get('fingerprint') != fingerprint:
+        print(f"{results_path} was written for different samples, settings or databases, starting over.")
+        return done
+    for line in lines[1:]:
+        try:
+            result = json.loads(line)
+        except ValueError:
+            continue
+        done[result['sql_idx']] = result
+    return done
+
+def run_sqls_parallel(sqls, vis_pairs, bin_by_pairs, db_places, db_ids, num_cpus=1, meta_time_out=30.0, group_by_db=True, gt_cache_path=GT_CACHE_PATH, max_rows=None, results_path=None,
+                      compare_mode='sorted', order_sensitive=False, resume=True):
+    """
+    Execute all SQL pairs in a pool of workers.
+    compare_mode selects how result sets are compared, see COMPARE_MODES; with order_sensitive,
+    the 'hash' mode also requires the row order to match when the ground truth has an ORDER BY.
+    When results_path is given, every result is appended to it as a JSON line as soon as it
+    completes, sent by the workers through a queue rather than with the rest of its batch; with resume, results already present in it are reused instead of being executed again,
+    provided they were produced by the same tasks, settings and database files.
+    """
+    tasks = []
     for i, (sql_pair, vis_pair, bin_by_pair) in enumerate(zip(sqls, vis_pairs, bin_by_pairs)):
         predicted_sql, ground_truth = sql_pair
         predicted_vis, ground_truth_vis = vis_pair
         predicted_bin_by, ground_truth_bin_by = bin_by_pair
-        result = pool.apply_async(execute_model,
-                                  args=(predicted_sql, ground_truth, predicted_vis, ground_truth_vis, predicted_bin_by, ground_truth_bin_by, db_places[i], i, meta_time_out, db_ids[i]))
-        exec_result.append(result)
-    pool.close()
-    pool.join()
+        tasks.append((predicted_sql, ground_truth, predicted_vis, ground_truth_vis, predicted_bin_by, ground_truth_bin_by, db_places[i], i, meta_time_out, db_ids[i]))
+    fingerprint = None
+    if results_path is not None:
+        db_hashes = {db_place: cached_hash_file(db_place) for db_place in sorted(set(db_places))
+                     if db_place is not None and os.path.isfile(db_place)}
+        fingerprint = hashlib.sha1(json.dumps([tasks, compare_mode, order_sensitive, max_rows, db_hashes]).encode('utf-8')).hexdigest()
+    done = load_exec_results(results_path, fingerprint) if resume else {}
+    if done:
+        print(f"Resuming from {results_path}: {len(done)}/{len(tasks)} samples already scored")
+    exec_result = list(done.values())
+    units = dedup_tasks([task for task in tasks if task[7] not in done])
+    results_file = None
+    result_queue = None
+    writer = None
+    if results_path is not None:
+        results_file = open_records_file(results_path, append=bool(done))
+        if not done:
+            results_file.write(json.dumps({'fingerprint': fingerprint}) + "\n")
+            results_file.flush()
+        result_queue = mp.Queue()
+        writer = threading.Thread(target=write_results, args=(result_queue, results_file), daemon=True)
+        writer.start()
+    try:
+        with mp.Pool(processes=num_cpus, initializer=init_worker,
+                     initargs=(gt_cache_path, max_rows, compare_mode, order_sensitive, result_queue)) as pool:
+            if group_by_db:
+                # Each database is handled by a single worker, keeping its connection and page cache warm
+                batches = group_units_by_db(units)
+                chunksize = 1
+            else:
+                # Each unit of duplicate predictions is still executed once, by a single worker
+                batches = units
+                chunksize = max(1, len(batches) // (num_cpus * 4))
+            for batch_result in pool.imap_unordered(execute_batch, batches, chunksize=chunksize):
+                exec_result.extend(batch_result)
+            # Workers exiting normally flush what they put on the result queue
+            pool.close()
+            pool.join()
+        if writer is not None:
+            result_queue.put(None)
+            writer.join()
+    finally:
+        if writer is not None and writer.is_alive():
+            # Interrupted: write what the workers already sent, without waiting on a queue they may have left broken
+            result_queue.put(None)
+            writer.join(timeout=10)
+        if results_file is not None:
+            results_file.close()
+    exec_result.sort(key=lambda result: result['sql_idx'])
     all_empty_db_ids = []
     final_results = []
     skipped_count = 0
     skipped_infos = []
-    for res in exec_result:
-        result = res.get()
+    for result in exec_result:
         final_results.append(result)
         all_empty_db_ids.extend(result['empty_db_ids'])
         if result['skipped']:
@@ -334,132 +792,309 @@ def run_sqls_parallel(sqls, vis_pairs, bin_by_pairs, db_places, db_ids, num_cpus
             skipped_infos.append(result['skipped_info'])
     return final_results, set(all_empty_db_ids), skipped_count, skipped_infos
 
-def find_sqlite_file(db_id):
-    db_dir = f"database/{db_id}/"
-    if os.path.exists(db_dir):
-        for root, dirs, files in os.walk(db_dir):
-            for file in files:
-                if file.endswith('.sqlite'):
-                    db_path = os.path.join(root, file)
-                    print(f"Found database file for {db_id}: {db_path}")
-                    return db_path
-    print(f"Could not find .sqlite database file for {db_id}")
+def find_sqlite_file_in_dir(db_dir):
+    """
+    Return the first .sqlite file found under db_dir, or None
+    """
+    for root, dirs, files in os.walk(db_dir):
+        for file in files:
+            if file.endswith('.sqlite'):
+                return os.path.join(root, file)
     return None
 
-# Main execution
-try:
-    with open('reponse.json', 'r') as f:
-        test_data = json.load(f)
-except FileNotFoundError:
-    print("Could not find response.json file, please check file path.")
-    exit(1)
-
-try:
-    with open('test.json', 'r') as f:
-        groundtruth_data = json.load(f)
-except FileNotFoundError:
-    print("Could not find test.json file, please check file path.")
-    exit(1)
-
-total_samples = len(test_data)
-valid_samples = 0
-vis_accuracies = []
-sql_accuracies = []
-bin_accuracies = []
-select_columns_accuracies = []
-data_accuracies = []
-all_accuracies = []
-
-# For database execution
-sql_pairs = []
-vis_pairs = []
-bin_by_pairs = []
-db_paths = []
-db_ids = []
-
-print("Processing samples for text-based evaluation...")
-
-for i in range(total_samples):
-    # Extract response VQL
-    response_text = test_data[i]['response_finetuned_model']
-    response_vql = extract_last_vql_1(response_text)
-    if not response_vql:
-        continue
-
-    # Extract ground truth VQL
-    groundtruth_text = groundtruth_data[i]['content_2']
-    groundtruth_vql = extract_last_vql(groundtruth_text)
-    if not groundtruth_vql:
-        continue
-
-    valid_samples += 1
-    
-    # Text-based evaluation
-    vis_acc, sql_acc, bin_acc, select_columns_acc, data_acc, all_acc = evaluate_accuracy(response_vql, groundtruth_vql)
-    vis_accuracies.append(vis_acc)
-    sql_accuracies.append(sql_acc)
-    bin_accuracies.append(bin_acc)
-    select_columns_accuracies.append(select_columns_acc)
-    data_accuracies.append(data_acc)
-    all_accuracies.append(all_acc)
-
-    # Prepare for database execution
-    response_sql = extract_sql(response_vql)
-    groundtruth_sql = extract_sql(groundtruth_vql)
-    response_vis = extract_vis(response_vql)
-    groundtruth_vis = extract_vis(groundtruth_vql)
-    response_bin_by = extract_bin(response_vql)
-    groundtruth_bin_by = extract_bin(groundtruth_vql)
-
-    # Get db_id and find database file
-    db_id = groundtruth_data[i]['db_id']
-    db_path = find_sqlite_file(db_id)
-    if db_path:
-        sql_pairs.append((response_sql, groundtruth_sql))
-        vis_pairs.append((response_vis, groundtruth_vis))
-        bin_by_pairs.append((response_bin_by, groundtruth_bin_by))
-        db_paths.append(db_path)
-        db_ids.append(db_id)
-
-# Calculate text-based accuracies
-avg_vis_accuracy = sum(vis_accuracies) / valid_samples if valid_samples > 0 else 0
-avg_sql_accuracy = sum(sql_accuracies) / valid_samples if valid_samples > 0 else 0
-avg_select_columns_accuracy = sum(select_columns_accuracies) / valid_samples if valid_samples > 0 else 0
-
-print(f"\n=== Text-based Evaluation Results ===")
-print(f"Chart Acc: {avg_vis_accuracy:.4f}")
-print(f"Axis Acc: {avg_select_columns_accuracy:.4f}")
-print(f"SQL Acc: {avg_sql_accuracy:.4f}")
-
-# Database execution evaluation
-if sql_pairs:
-    print("\nProcessing samples for database execution evaluation...")
-    exec_results, empty_db_ids, skipped_count, skipped_infos = run_sqls_parallel(
-        sql_pairs, vis_pairs, bin_by_pairs, db_paths, db_ids, 
-        num_cpus=mp.cpu_count(), meta_time_out=30.0
-    )
-    
-    correct_sql_count = sum([res['sql_res'] for res in exec_results])
-    correct_all_count = sum([res['all_res'] for res in exec_results])
-    
-    avg_sql_execution_accuracy = (correct_sql_count / len(exec_results)) * 100 if exec_results else 0
-    avg_all_execution_accuracy = (correct_all_count / len(exec_results)) * 100 if exec_results else 0
-    
-    print(f"\n=== Database Execution Evaluation Results ===")
-    print(f"Data Acc: {avg_sql_execution_accuracy:.2f}%")
-    print(f"All Acc: {avg_all_execution_accuracy:.2f}%")
-    
-    if empty_db_ids:
-        print(f"Empty db_ids: {empty_db_ids}")
-    if skipped_count > 0:
-        print(f"Skipped SQL executions: {skipped_count}")
-else:
-    print("\nNo valid SQL pairs found for database execution evaluation.")
-
-print(f"\n=== Summary ===")
-print(f"Chart Acc: {avg_vis_accuracy:.4f}")
-print(f"Axis Acc: {avg_select_columns_accuracy:.4f}")
-print(f"SQL Acc: {avg_sql_accuracy:.4f}")
-if sql_pairs:
-    print(f"Data Acc: {avg_sql_execution_accuracy:.2f}%")
-    print(f"All Acc: {avg_all_execution_accuracy:.2f}%")
+def build_db_index(db_root=DB_ROOT):
+    """
+    Scan db_root once and map every db_id to its .sqlite file (None if it has none).
+    The modification time of each database directory is kept for invalidation.
+    """
+    index = {}
+    if not os.path.isdir(db_root):
+        return index
+    for db_id in sorted(os.listdir(db_root)):
+        db_dir = os.path.join(db_root, db_id)
+        if os.path.isdir(db_dir):
+            index[db_id] = {'path': find_sqlite_file_in_dir(db_dir), 'mtime': os.path.getmtime(db_dir)}
+    return index
+
+def is_db_index_valid(index, db_root):
+    db_ids = {name for name in os.listdir(db_root) if os.path.isdir(os.path.join(db_root, name))}
+    if db_ids != set(index):
+        return False
+    for db_id, item in index.items():
+        if os.path.getmtime(os.path.join(db_root, db_id)) != item['mtime']:
+            return False
+        if item['path'] is not None and not os.path.exists(item['path']):
+            return False
+    return True
+
+def load_db_index(db_root=DB_ROOT, manifest_path=None):
+    """
+    Return the db_id -> database file index of db_root.
+    When manifest_path is given, the index is read from it if still valid, and rewritten otherwise.
+    """
+    if manifest_path is not None and os.path.exists(manifest_path) and os.path.isdir(db_root):
+        try:
+            with open(manifest_path, 'r') as f:
+                manifest = json.load(f)
+            if manifest.get('db_root') == os.path.abspath(db_root) and is_db_index_valid(manifest['index'], db_root):
+                return manifest['index']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    index = build_db_index(db_root)
+    if manifest_path is not None:
+        try:
+            with open(manifest_path, 'w') as f:
+                json.dump({'db_root': os.path.abspath(db_root), 'index': index}, f)
+        except OSError as e:
+            print(f"Could not write database index {manifest_path}: {e}")
+    return index
+
+def lookup_db_path(index, db_id):
+    """
+    Return the .sqlite file of db_id, or None if the database is missing
+    """
+    item = index.get(db_id)
+    return item['path'] if item is not None else None
+
+def breakdown(table, by):
+    """
+    Mean of every metric and number of samples for each value of the column(s) by
+    """
+    grouped = table.groupby(by, dropna=False)
+    result = grouped[METRIC_COLUMNS].mean()
+    result.insert(0, 'count', grouped.size())
+    return result
+
+def bootstrap_ci(table, columns=METRIC_COLUMNS, n_bootstrap=1000, confidence=0.95, seed=0, batch_size=100):
+    """
+    Percentile bootstrap confidence intervals of the mean of each metric column.
+    Resamples are drawn as multinomial sample weights, batch_size at a time, so all columns
+    share the same resamples and each batch is reduced with one matrix product.
+    """
+    values = table[columns].to_numpy(dtype=float)
+    observed = ~np.isnan(values)
+    values = np.where(observed, values, 0.0)
+    n = len(values)
+    result = pd.DataFrame({'mean': table[columns].mean(), 'lower': np.nan, 'upper': np.nan}, index=columns)
+    if n == 0 or n_bootstrap <= 0:
+        return result
+    rng = np.random.default_rng(seed)
+    means = []
+    for start in range(0, n_bootstrap, batch_size):
+        weights = rng.multinomial(n, np.full(n, 1.0 / n), size=min(batch_size, n_bootstrap - start))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means.append((weights @ values) / (weights @ observed))
+    means = np.concatenate(means)
+    alpha = (1 - confidence) / 2
+    with warnings.catch_warnings():
+        # Columns without any observed value (e.g. no executed samples) stay NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        result['lower'], result['upper'] = np.nanpercentile(means, [alpha * 100, (1 - alpha) * 100], axis=0)
+    return result
+
+def evaluate(predictions, references, db_root=DB_ROOT, workers=None, meta_time_out=30.0, max_rows=None,
+             group_by_db=True, gt_cache_path=GT_CACHE_PATH, results_path=None, n_bootstrap=1000,
+             compare_mode='sorted', order_sensitive=False, resume=True, db_index_path=None):
+    """
+    Evaluate model predictions against nvBench-CoT references.
+    predictions holds response texts or items with a 'response_finetuned_model' field, and references
+    holds items with 'content_2' and 'db_id', aligned by position. Returns a dict of metrics;
+    accuracies are fractions, and the execution ones are None when no sample could be executed.
+    The per-sample table, breakdowns by chart type, db_id and BIN presence, and bootstrap
+    confidence intervals are included as pandas DataFrames.
+    db_root is scanned for the database files, through the manifest at db_index_path when given.
+    """
+    total_samples = len(predictions)
+    # One row per valid sample, see TABLE_COLUMNS
+    rows = []
+
+    # For database execution
+    sql_pairs = []
+    vis_pairs = []
+    bin_by_pairs = []
+    db_paths = []
+    db_ids = []
+    exec_rows = []
+
+    print("Processing samples for text-based evaluation...")
+    db_index = load_db_index(db_root, db_index_path)
+    missing_db_ids = set()
+
+    for i in range(total_samples):
+        # Extract response VQL
+        prediction = predictions[i]
+        response_text = prediction if isinstance(prediction, str) else prediction['response_finetuned_model']
+        response_vql = extract_last_vql_1(response_text)
+        if not response_vql:
+            continue
+
+        # Extract ground truth VQL
+        groundtruth_text = references[i]['content_2']
+        groundtruth_vql = extract_last_vql(groundtruth_text)
+        if not groundtruth_vql:
+            continue
+
+        # Prepare for database execution, both statements are parsed once and cached
+        response = parse_vql(response_vql)
+        groundtruth = parse_vql(groundtruth_vql)
+        response_sql, groundtruth_sql = response.sql, groundtruth.sql
+        response_vis, groundtruth_vis = response.chart_type, groundtruth.chart_type
+        response_bin_by, groundtruth_bin_by = response.bin, groundtruth.bin
+        db_id = references[i]['db_id']
+
+        # Text-based evaluation
+        vis_acc, sql_acc, bin_acc, select_columns_acc, data_acc, all_acc = evaluate_accuracy(response_vql, groundtruth_vql)
+        rows.append((i, db_id, groundtruth_vis, groundtruth_bin_by is not None,
+                     vis_acc, select_columns_acc, sql_acc, bin_acc, data_acc, all_acc, np.nan, np.nan))
+
+        # Find database file
+        db_path = lookup_db_path(db_index, db_id)
+        if db_path is None:
+            missing_db_ids.add(db_id)
+        else:
+            exec_rows.append(len(rows) - 1)
+            sql_pairs.append((response_sql, groundtruth_sql))
+            vis_pairs.append((response_vis, groundtruth_vis))
+            bin_by_pairs.append((response_bin_by, groundtruth_bin_by))
+            db_paths.append(db_path)
+            db_ids.append(db_id)
+
+    if missing_db_ids:
+        print(f"Could not find .sqlite database file for {len(missing_db_ids)} db_ids: {sorted(missing_db_ids)}")
+
+    table = pd.DataFrame.from_records(rows, columns=TABLE_COLUMNS)
+    table[METRIC_COLUMNS] = table[METRIC_COLUMNS].astype(float)
+    valid_samples = len(table)
+
+    # Calculate text-based accuracies
+    metrics = {
+        'total_samples': total_samples,
+        'valid_samples': valid_samples,
+        'chart_acc': table['chart_acc'].mean() if valid_samples > 0 else 0,
+        'axis_acc': table['axis_acc'].mean() if valid_samples > 0 else 0,
+        'sql_acc': table['sql_acc'].mean() if valid_samples > 0 else 0,
+        'data_acc': None,
+        'all_acc': None,
+        'executed_samples': 0,
+        'missing_db_ids': missing_db_ids,
+        'empty_db_ids': set(),
+        'skipped_count': 0,
+        'skipped_infos': [],
+        'exec_results': [],
+    }
+
+    # Database execution evaluation
+    if sql_pairs:
+        print("\nProcessing samples for database execution evaluation...")
+        exec_results, empty_db_ids, skipped_count, skipped_infos = run_sqls_parallel(
+            sql_pairs, vis_pairs, bin_by_pairs, db_paths, db_ids,
+            num_cpus=workers or mp.cpu_count(), meta_time_out=meta_time_out, group_by_db=group_by_db,
+            gt_cache_path=gt_cache_path, max_rows=max_rows, results_path=results_path,
+            compare_mode=compare_mode, order_sensitive=order_sensitive, resume=resume
+        )
+
+        # Scatter execution results back onto the rows of their samples
+        positions = np.array([exec_rows[res['sql_idx']] for res in exec_results], dtype=int)
+        table.loc[positions, 'data_acc'] = np.array([res['sql_res'] for res in exec_results], dtype=float)
+        table.loc[positions, 'all_acc'] = np.array([res['all_res'] for res in exec_results], dtype=float)
+
+        metrics['data_acc'] = table['data_acc'].mean() if exec_results else 0
+        metrics['all_acc'] = table['all_acc'].mean() if exec_results else 0
+        metrics['executed_samples'] = len(exec_results)
+        metrics['empty_db_ids'] = empty_db_ids
+        metrics['skipped_count'] = skipped_count
+        metrics['skipped_infos'] = skipped_infos
+        metrics['exec_results'] = exec_results
+    else:
+        print("\nNo valid SQL pairs found for database execution evaluation.")
+
+    metrics['table'] = table
+    metrics['by_chart_type'] = breakdown(table, 'chart_type')
+    metrics['by_db_id'] = breakdown(table, 'db_id')
+    metrics['by_bin'] = breakdown(table, 'has_bin')
+    metrics['confidence_intervals'] = bootstrap_ci(table, n_bootstrap=n_bootstrap)
+    return metrics
+
+def print_metrics(metrics, breakdowns=False):
+    print(f"\n=== Text-based Evaluation Results ===")
+    print(f"Chart Acc: {metrics['chart_acc']:.4f}")
+    print(f"Axis Acc: {metrics['axis_acc']:.4f}")
+    print(f"SQL Acc: {metrics['sql_acc']:.4f}")
+
+    if metrics['data_acc'] is not None:
+        print(f"\n=== Database Execution Evaluation Results ===")
+        print(f"Data Acc: {metrics['data_acc'] * 100:.2f}%")
+        print(f"All Acc: {metrics['all_acc'] * 100:.2f}%")
+        if metrics['empty_db_ids']:
+            print(f"Empty db_ids: {metrics['empty_db_ids']}")
+        if metrics['skipped_count'] > 0:
+            print(f"Skipped SQL executions: {metrics['skipped_count']}")
+
+    print(f"\n=== Summary ===")
+    print(f"Chart Acc: {metrics['chart_acc']:.4f}")
+    print(f"Axis Acc: {metrics['axis_acc']:.4f}")
+    print(f"SQL Acc: {metrics['sql_acc']:.4f}")
+    if metrics['data_acc'] is not None:
+        print(f"Data Acc: {metrics['data_acc'] * 100:.2f}%")
+        print(f"All Acc: {metrics['all_acc'] * 100:.2f}%")
+
+    if breakdowns:
+        with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 200, 'display.float_format', '{:.4f}'.format):
+            print(f"\n=== Confidence Intervals ===")
+            print(metrics['confidence_intervals'])
+            print(f"\n=== By Chart Type ===")
+            print(metrics['by_chart_type'])
+            print(f"\n=== By BIN Presence ===")
+            print(metrics['by_bin'])
+            print(f"\n=== By db_id ===")
+            print(metrics['by_db_id'])
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate generated VQL against nvBench-CoT ground truth")
+    parser.add_argument("--predictions", default="reponse.json", help="JSON file with response_finetuned_model fields")
+    parser.add_argument("--references", default="test.json", help="JSON file with content_2 and db_id fields")
+    parser.add_argument("--db-root", default=DB_ROOT, help="directory with one sub-directory per db_id")
+    parser.add_argument("--db-index", default=DB_INDEX_FILE,
+                        help="manifest caching the database index of --db-root between runs")
+    parser.add_argument("--no-db-index", action="store_true", help="scan --db-root without reading or writing a manifest")
+    parser.add_argument("--workers", type=int, default=mp.cpu_count())
+    parser.add_argument("--timeout", type=float, default=30.0, help="per-query execution timeout in seconds")
+    parser.add_argument("--max-rows", type=int, default=None, help="abort predicted SQL returning more rows")
+    parser.add_argument("--schedule", choices=["db", "sample"], default="db",
+                        help="dispatch work grouped by database or by sample")
+    parser.add_argument("--compare", choices=COMPARE_MODES, default="sorted",
+                        help="compare sorted result sets, or streamed row counts and digests")
+    parser.add_argument("--order-sensitive", action="store_true",
+                        help="with --compare hash, require matching row order when the ground truth has ORDER BY")
+    parser.add_argument("--gt-cache", default=GT_CACHE_PATH, help="ground-truth result cache file")
+    parser.add_argument("--no-gt-cache", action="store_true", help="always execute the ground-truth SQL")
+    parser.add_argument("--results", default=EXEC_RESULTS_PATH, help="JSONL file execution results are streamed to")
+    parser.add_argument("--resume", action="store_true",
+                        help="reuse the results in --results written by a run with the same samples and settings")
+    parser.add_argument("--breakdowns", action="store_true", help="print per chart type, BIN presence and db_id metrics")
+    parser.add_argument("--bootstrap", type=int, default=1000, help="number of bootstrap resamples for confidence intervals")
+    args = parser.parse_args()
+
+    try:
+        with open(args.predictions, 'r') as f:
+            test_data = json.load(f)
+    except FileNotFoundError:
+        print(f"Could not find {args.predictions} file, please check file path.")
+        exit(1)
+
+    try:
+        with open(args.references, 'r') as f:
+            groundtruth_data = json.load(f)
+    except FileNotFoundError:
+        print(f"Could not find {args.references} file, please check file path.")
+        exit(1)
+
+    metrics = evaluate(test_data, groundtruth_data, db_root=args.db_root, workers=args.workers,
+                       meta_time_out=args.timeout, max_rows=args.max_rows, group_by_db=args.schedule == "db",
+                       gt_cache_path=None if args.no_gt_cache else args.gt_cache, results_path=args.results,
+                       n_bootstrap=args.bootstrap, compare_mode=args.compare, order_sensitive=args.order_sensitive,
+                       resume=args.resume, db_index_path=None if args.no_db_index else args.db_index)
+    print_metrics(metrics, breakdowns=args.breakdowns)
+
+if __name__ == "__main__":
+    main()
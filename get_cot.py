@@ -1,10 +1,17 @@
 import json
-import requests
+import os
+import re
+import time
+import hashlib
+import sqlite3
+import random
+import asyncio
+import argparse
+from email.utils import parsedate_to_datetime
+import httpx
+from openai import OpenAI
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor
-
-with open('processed_nvbench.json', 'r', encoding='utf-8') as f:
-    dataset = json.load(f)
+from data_loader import load_records, open_records_file
 
 
 url = "Fill in the specific API request URL"
@@ -12,6 +19,40 @@ headers = {
     "Content-Type": "Fill in the appropriate content type, e.g., application/json",
     "Authorization": "Fill in the actual authorization token, usually in the format of Bearer <token>"
 }
+MODEL = "gpt-3.5-turbo"
+# Maximum number of requests in flight, which is also the size of the keep-alive connection pool
+CONCURRENCY = 50
+# Seconds allowed for a single chat completion request
+REQUEST_TIMEOUT = 300
+# API quota, enforced client-side with token buckets
+REQUESTS_PER_MINUTE = 500
+TOKENS_PER_MINUTE = 200000
+# Completion tokens reserved per request before the actual usage is known
+EXPECTED_COMPLETION_TOKENS = 1024
+# Retries of transient failures, with jittered exponential backoff capped at BACKOFF_MAX seconds
+MAX_RETRIES = 6
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+REQUEST_ERROR_PREFIX = "Request error: "
+PARSE_ERROR_MESSAGE = "Error parsing the response. The response format may not meet expectations."
+# Local cache of API responses, trimmed to RESPONSE_CACHE_MAX_BYTES of content by least recent use
+RESPONSE_CACHE_PATH = "cot_response_cache.sqlite"
+RESPONSE_CACHE_MAX_BYTES = 1 << 30
+# Cache hits whose access times are buffered before being written in one transaction
+RESPONSE_CACHE_ACCESS_BATCH = 1000
+# Rounds of regeneration for items whose reasoning fails validate_reasoning
+REGENERATION_ROUNDS = 1
+# Fields of the reasoning format requested by build_prompt, and the ones that must be present
+REASONING_FIELDS = ["Chart Type", "FROM", "SELECT", "WHERE", "GROUP BY", "BIN", "BY", "ORDER BY", "SORT DIRECTION", "LIMIT"]
+REQUIRED_REASONING_FIELDS = ["Chart Type", "FROM", "SELECT", "GROUP BY", "BIN", "ORDER BY", "LIMIT"]
+# Values a model writes for a clause that is absent from the VQL, after normalize_field
+EMPTY_FIELD_VALUES = {"", "NONE", "EMPTY", "N/A", "NA", "NULL", "-", "NOTAPPLICABLE", "[]"}
+# Provider batch API, configured through the OPENAI_API_KEY and OPENAI_BASE_URL environment variables
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_POLL_INTERVAL = 60
+BATCH_FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
 
 def format_VQL(vql):
     aggregations = ["SUM", "AVG", "COUNT", "MAX", "MIN"]
@@ -97,7 +138,308 @@ LIMIT: [Number of rows for the LIMIT clause from the Pre - entered Correct VQL]
     return constraint_text.replace("{question}", question).replace("{db_schema}", "\n".join(db_schema)).replace("[VQL]", VQL)
 
 
-def process_item(item):
+class RateLimiter:
+    """
+    Token buckets for requests per minute and tokens per minute, refilled continuously.
+    Waiters are served in arrival order.
+    """
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE):
+        self.capacity = {"requests": requests_per_minute, "tokens": tokens_per_minute}
+        self.available = dict(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        for key, capacity in self.capacity.items():
+            self.available[key] = min(capacity, self.available[key] + elapsed * capacity / 60)
+
+    async def acquire(self, tokens):
+        tokens = min(tokens, self.capacity["tokens"])
+        async with self.lock:
+            while True:
+                self.refill()
+                wait = max(0, (1 - self.available["requests"]) * 60 / self.capacity["requests"],
+                           (tokens - self.available["tokens"]) * 60 / self.capacity["tokens"])
+                if wait == 0:
+                    self.available["requests"] -= 1
+                    self.available["tokens"] -= tokens
+                    return
+                await asyncio.sleep(wait)
+
+    def record_usage(self, estimated_tokens, used_tokens):
+        # Settle the difference between the reservation and the usage reported by the API
+        self.available["tokens"] -= used_tokens - estimated_tokens
+
+def estimate_tokens(prompt):
+    return len(prompt) // 4 + EXPECTED_COMPLETION_TOKENS
+
+def retry_after(response):
+    """
+    Seconds requested by a Retry-After header, or None
+    """
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+async def post_with_retry(client, semaphore, limiter, data, estimated_tokens):
+    """
+    POST a chat request throttled by limiter, retrying transport errors and retryable status codes
+    with jittered exponential backoff; a Retry-After header takes precedence over the backoff.
+    """
+    attempt = 0
+    while True:
+        if limiter is not None:
+            await limiter.acquire(estimated_tokens)
+        try:
+            async with semaphore:
+                response = await client.post(url, headers=headers, json=data)
+            response.raise_for_status()
+            return response
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            if isinstance(e, httpx.HTTPStatusError) and e.response.status_code not in RETRY_STATUS_CODES:
+                raise
+            if attempt >= MAX_RETRIES:
+                raise
+            delay = retry_after(e.response) if isinstance(e, httpx.HTTPStatusError) else None
+            if delay is None:
+                delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+            attempt += 1
+            await asyncio.sleep(delay)
+
+class ResponseCache:
+    """
+    Persistent cache of chat completion contents, keyed by the SHA-256 of the model name and full prompt.
+    Access times of hits are buffered and written in batches, before any eviction and on close.
+    """
+    def __init__(self, path=RESPONSE_CACHE_PATH, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses "
+                          "(key TEXT PRIMARY KEY, content TEXT, size INTEGER, accessed REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.conn.commit()
+        self.max_bytes = max_bytes
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> access time of the hits not written yet
+        self.accessed = {}
+
+    @staticmethod
+    def key(model, prompt):
+        return hashlib.sha256(f"{model}\0{prompt}".encode("utf-8")).hexdigest()
+
+    def get(self, model, prompt):
+        key = self.key(model, prompt)
+        row = self.conn.execute("SELECT content FROM responses WHERE key=?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.accessed[key] = time.time()
+        if len(self.accessed) >= RESPONSE_CACHE_ACCESS_BATCH:
+            self.flush_accessed()
+            self.conn.commit()
+        return row[0]
+
+    def flush_accessed(self):
+        # Written in the current transaction, committed by the caller
+        self.conn.executemany("UPDATE responses SET accessed=? WHERE key=?",
+                              [(accessed, key) for key, accessed in self.accessed.items()])
+        self.accessed.clear()
+
+    def put(self, model, prompt, content):
+        key = self.key(model, prompt)
+        size = len(content.encode("utf-8"))
+        old = self.conn.execute("SELECT size FROM responses WHERE key=?", (key,)).fetchone()
+        self.conn.execute("INSERT OR REPLACE INTO responses (key, content, size, accessed) VALUES (?, ?, ?, ?)",
+                          (key, content, size, time.time()))
+        self.accessed.pop(key, None)
+        self.total_bytes += size - (old[0] if old else 0)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+        self.conn.commit()
+
+    def evict(self):
+        # Drop least recently used entries until the cache is back to 90% of its budget
+        self.flush_accessed()
+        target = self.max_bytes * 0.9
+        rows = self.conn.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall()
+        evicted = []
+        for key, size in rows:
+            if self.total_bytes <= target:
+                break
+            evicted.append((key,))
+            self.total_bytes -= size
+        self.conn.executemany("DELETE FROM responses WHERE key=?", evicted)
+        self.evictions += len(evicted)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0
+        return (f"Response cache: {self.hits} hits, {self.misses} misses ({hit_rate:.2%} hit rate), "
+                f"{self.evictions} evictions, {self.total_bytes / (1 << 20):.1f} MiB stored")
+
+    def close(self):
+        self.flush_accessed()
+        self.conn.commit()
+        self.conn.close()
+
+def item_id(item):
+    """
+    Stable identifier of a dataset item, derived from the fields the prompt is built from
+    """
+    key = json.dumps([item["question"], item["Database Schema"], item["VQL"]], ensure_ascii=False)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+def load_progress(progress_path):
+    """
+    Read the items with valid reasoning from a JSONL progress file, keyed by item id.
+    Lines truncated by an interruption are ignored.
+    """
+    done = {}
+    if progress_path is None or not os.path.exists(progress_path):
+        return done
+    with open(progress_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if has_valid_reasoning(record["item"]):
+                done[record["id"]] = record["item"]
+    return done
+
+def has_valid_reasoning(item):
+    reasoning_content = item.get("reasoning_content")
+    return bool(reasoning_content) and not reasoning_content.startswith(REQUEST_ERROR_PREFIX) \
+        and reasoning_content != PARSE_ERROR_MESSAGE
+
+_REASONING_FIELD_PATTERN = re.compile(
+    r'^[\s*#>-]*(?:Step\s*[1-4]\s*:[\s*]*)?(' + '|'.join(sorted(map(re.escape, REASONING_FIELDS), key=len, reverse=True)) + r')\s*\**\s*:\s*\**(.*)$',
+    re.IGNORECASE | re.MULTILINE)
+_VQL_CLAUSE_PATTERN = re.compile(r'\b(VISUALIZE|SELECT|FROM|WHERE|GROUP\s+BY|ORDER\s+BY|LIMIT|BIN)\b', re.IGNORECASE)
+_BIN_BY_PATTERN = re.compile(r'^(.*?)\s*\bBY\b\s*(.*)$', re.IGNORECASE | re.DOTALL)
+# A word of a short phrasing of an absent clause
+_EMPTY_FIELD_WORD = r"(?:\s+[a-z_']+)"
+# Explanation following an empty value, in parentheses or after a comma, semicolon, colon, dash or period.
+# Digits, comparison operators and double quotes make it name a condition, so "None, except date > 2000"
+# is not taken as empty.
+_EMPTY_FIELD_EXPLANATION = r"""(?:\s*[(,;:.\-–—][^0-9<>=!"]*)?"""
+# Whole-value phrasings of an absent clause: an empty value or a short negation, optionally explained,
+# e.g. "N/A (no limit)", "None, since no filter is needed", "No limit is needed." or "[BIN_COLUMN not specified]"
+_EMPTY_FIELD_PATTERN = re.compile(
+    r"^\W*(?:"
+    r"(?:none|n/?a|null|nil|empty|nothing|-)"
+    r"|(?:there\s+(?:is|are)\s+)?(?:no|none|nothing|n/?a|null|nil|empty|unspecified|omitted|absent|without)\b" + _EMPTY_FIELD_WORD + r"{0,8}"
+    r"|(?:[a-z_]+\s+){0,4}(?:(?:is|are)\s+)?not\s+(?:specified|applicable|needed|required|present|used|provided|included|given|mentioned)\b"
+    + _EMPTY_FIELD_WORD + r"{0,4}"
+    r")" + _EMPTY_FIELD_EXPLANATION + r"\W*$",
+    re.IGNORECASE)
+_SORT_DIRECTION_PATTERN = re.compile(r'\s+(ASC|DESC)\b', re.IGNORECASE)
+_STEP_PATTERN = re.compile(r'Step\s*([1-4])\s*:', re.IGNORECASE)
+
+def parse_reasoning(reasoning):
+    """
+    Extract the field lines (Chart Type:, FROM:, ...) of a reasoning, the last occurrence of each winning
+    """
+    fields = {}
+    for match in _REASONING_FIELD_PATTERN.finditer(reasoning):
+        name = next(field for field in REASONING_FIELDS if field.lower() == match.group(1).lower())
+        fields[name] = match.group(2).strip()
+    return fields
+
+def expected_reasoning_fields(formatted_VQL):
+    """
+    Field values a reasoning must report for the VQL shown in the prompt, as produced by format_VQL.
+    format_VQL drops the BIN column ("BIN BY YEAR"), so that field is None when the prompt does not show it.
+    """
+    VQL = formatted_VQL
+    clauses = {}
+    matches = list(_VQL_CLAUSE_PATTERN.finditer(VQL))
+    for match, next_match in zip(matches, matches[1:] + [None]):
+        end = next_match.start() if next_match is not None else len(VQL)
+        clauses[" ".join(match.group(1).upper().split())] = VQL[match.end():end].strip()
+    order_by = clauses.get("ORDER BY", "")
+    bin_column, bin_unit = clauses.get("BIN", ""), ""
+    bin_match = _BIN_BY_PATTERN.match(bin_column)
+    if bin_match is not None:
+        bin_column, bin_unit = bin_match.group(1).strip(), bin_match.group(2).strip()
+    if "BIN" in clauses and not bin_column:
+        bin_column = None
+    return {
+        "Chart Type": clauses.get("VISUALIZE", ""),
+        "FROM": clauses.get("FROM", ""),
+        "SELECT": clauses.get("SELECT", ""),
+        "WHERE": clauses.get("WHERE", ""),
+        "GROUP BY": clauses.get("GROUP BY", ""),
+        "BIN": bin_column,
+        "BY": bin_unit,
+        "ORDER BY": _SORT_DIRECTION_PATTERN.sub("", order_by),
+        "SORT DIRECTION": " ".join(m.group(1).upper() for m in _SORT_DIRECTION_PATTERN.finditer(order_by)),
+        "LIMIT": clauses.get("LIMIT", ""),
+    }
+
+def normalize_field(name, value):
+    value = re.sub(r'[\s`"\'\[\]]', '', value).upper().rstrip('.')
+    if name == "ORDER BY":
+        value = re.sub(r'(ASC|DESC)(?=,|$)', '', value)
+    return "" if value in EMPTY_FIELD_VALUES else value
+
+def is_empty_field(name, value):
+    """
+    Whether a reasoning field value says that its clause is absent
+
+    >>> [is_empty_field("LIMIT", value) for value in ("N/A (no limit)", "No limit is needed.", "5")]
+    [True, True, False]
+    >>> is_empty_field("SORT DIRECTION", "None (no ORDER BY)")
+    True
+    >>> [is_empty_field("WHERE", value) for value in ("None, since no filter is needed", "None, except date > 2000")]
+    [True, False]
+    """
+    return normalize_field(name, value) == "" or _EMPTY_FIELD_PATTERN.search(value) is not None
+
+def validate_reasoning(reasoning, VQL):
+    """
+    Check a generated reasoning against the strict Step 1-4 format of build_prompt and the fields
+    of the pre-entered VQL as the prompt shows it (format_VQL). Fields of clauses absent from the VQL
+    may be written as "None", "No limit is needed." and the like.
+    Returns the list of problems found, empty when the reasoning is valid.
+    """
+    problems = []
+    steps = {int(step) for step in _STEP_PATTERN.findall(reasoning)}
+    problems.extend(f"missing Step {step}" for step in range(1, 5) if step not in steps)
+    fields = parse_reasoning(reasoning)
+    for name, expected in expected_reasoning_fields(format_VQL(VQL)).items():
+        if name not in fields:
+            if name in REQUIRED_REASONING_FIELDS:
+                problems.append(f"missing {name}")
+            continue
+        if expected is None:
+            # Not shown in the prompt, any answer is accepted
+            continue
+        if not normalize_field(name, expected):
+            if not is_empty_field(name, fields[name]):
+                problems.append(f"{name}: expected no value, got {fields[name]!r}")
+        elif normalize_field(name, fields[name]) != normalize_field(name, expected):
+            problems.append(f"{name}: expected {expected!r}, got {fields[name]!r}")
+    return problems
+
+def build_request(item):
+    """
+    Return the prompt of an item and the chat completion request body sent for it
+    """
     question = item["question"]
     db_schema = item["Database Schema"]
     VQL = item["VQL"]
@@ -106,18 +448,35 @@ def process_item(item):
     prompt = build_prompt(question, db_schema, formatted_VQL)
 
     data = {
-        "model": "gpt-3.5-turbo",
+        "model": MODEL,
         "messages": [
             {"role": "user", "content": prompt}
         ]
     }
+    return prompt, data
 
+async def process_item(client, semaphore, item, limiter=None, cache=None, refresh=False):
+    question = item["question"]
+    prompt, data = build_request(item)
+
+    # With refresh, the cached response is replaced by a new one
+    reasoning_content = cache.get(MODEL, prompt) if cache is not None and not refresh else None
+    if reasoning_content is not None:
+        new_item = item.copy()
+        new_item["reasoning_content"] = reasoning_content
+        return new_item
+
+    estimated_tokens = estimate_tokens(prompt)
     try:
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()
+        response = await post_with_retry(client, semaphore, limiter, data, estimated_tokens)
 
         result = response.json()
         reasoning_content = result["choices"][0]["message"]["content"]
+        used_tokens = result.get("usage", {}).get("total_tokens")
+        if limiter is not None and used_tokens:
+            limiter.record_usage(estimated_tokens, used_tokens)
+        if cache is not None:
+            cache.put(MODEL, prompt, reasoning_content)
 
         new_item = item.copy()
         new_item["reasoning_content"] = reasoning_content
@@ -127,21 +486,233 @@ def process_item(item):
         print("-" * 80)
 
         return new_item
-    except requests.RequestException as e:
-        print(f"Request error: {e}")
+    except httpx.HTTPError as e:
+        print(f"{REQUEST_ERROR_PREFIX}{e}")
         new_item = item.copy()
-        new_item["reasoning_content"] = f"Request error: {e}"
+        new_item["reasoning_content"] = f"{REQUEST_ERROR_PREFIX}{e}"
         return new_item
-    except (KeyError, IndexError):
-        print("Error parsing the response. The response format may not meet expectations.")
+    except (KeyError, IndexError, ValueError, AttributeError):
+        print(PARSE_ERROR_MESSAGE)
         new_item = item.copy()
-        new_item["reasoning_content"] = "Error parsing the response. The response format may not meet expectations."
+        new_item["reasoning_content"] = PARSE_ERROR_MESSAGE
         return new_item
 
-new_dataset = []
-with ThreadPoolExecutor(max_workers=50) as executor:
-    results = list(tqdm(executor.map(process_item, dataset), total=len(dataset), desc="Processing items", unit="item"))
-    new_dataset.extend(results)
+async def process_dataset(dataset, concurrency=CONCURRENCY, limiter=None, progress_path=None, resume=False, cache=None,
+                          regeneration_rounds=REGENERATION_ROUNDS, overwrite=False):
+    """
+    Run process_item over the dataset with at most `concurrency` requests in flight,
+    sharing one pool of keep-alive connections and throttled by limiter.
+    Prompts found in cache are answered locally without any request.
+    Items that still failed after their retries are re-queued once in a final pass, and items whose
+    reasoning fails validate_reasoning are regenerated up to regeneration_rounds times, including items
+    restored from the progress file.
+    When progress_path is given, each result is appended to it as a JSON line when it completes;
+    with resume, items already stored there with valid reasoning are not requested again.
+    A non-empty progress file is only replaced with overwrite, otherwise FileExistsError is raised.
+    Results keep the dataset order.
+    """
+    if (progress_path is not None and not resume and not overwrite
+            and os.path.exists(progress_path) and os.path.getsize(progress_path) > 0):
+        raise FileExistsError(f"{progress_path} already holds results, pass --resume to continue or --overwrite to replace it")
+    done = load_progress(progress_path) if resume else {}
+    ids = [item_id(item) for item in dataset]
+    results = [done.get(id_) for id_ in ids]
+    pending = [i for i, new_item in enumerate(results) if new_item is None]
+    if done:
+        print(f"Resuming: {len(dataset) - len(pending)}/{len(dataset)} items already have reasoning")
+
+    progress_file = None
+    if progress_path is not None:
+        progress_file = open_records_file(progress_path, append=resume)
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    try:
+        async with httpx.AsyncClient(limits=limits, timeout=REQUEST_TIMEOUT) as client:
+            async def run(indices, desc, refresh=False):
+                with tqdm(total=len(indices), desc=desc, unit="item") as progress:
+                    async def run_one(i):
+                        new_item = await process_item(client, semaphore, dataset[i], limiter, cache, refresh)
+                        if progress_file is not None:
+                            progress_file.write(json.dumps({"id": ids[i], "item": new_item}, ensure_ascii=False) + "\n")
+                            progress_file.flush()
+                        progress.update(1)
+                        results[i] = new_item
+
+                    await asyncio.gather(*(run_one(i) for i in indices))
+
+            await run(pending, "Processing items")
+
+            failed = [i for i in pending if not has_valid_reasoning(results[i])]
+            if failed:
+                print(f"Re-queuing {len(failed)} failed items")
+                await run(failed, "Retrying failed items")
+                print(f"Items still failing: {sum(not has_valid_reasoning(results[i]) for i in failed)}")
+
+            for round_ in range(regeneration_rounds):
+                invalid = [i for i in range(len(dataset)) if has_valid_reasoning(results[i])
+                           and validate_reasoning(results[i]["reasoning_content"], dataset[i]["VQL"])]
+                if not invalid:
+                    break
+                print(f"Regenerating {len(invalid)} items with invalid reasoning (round {round_ + 1})")
+                await run(invalid, "Regenerating items", refresh=True)
+            invalid_count = sum(has_valid_reasoning(results[i])
+                                and bool(validate_reasoning(results[i]["reasoning_content"], dataset[i]["VQL"]))
+                                for i in range(len(dataset)))
+            if invalid_count:
+                print(f"Items with invalid reasoning after regeneration: {invalid_count}")
+    finally:
+        if progress_file is not None:
+            progress_file.close()
+    return results
+
+def write_batch_requests(dataset, requests_path, cache=None):
+    """
+    Write one batch request per distinct item id to requests_path.
+    Prompts already in cache are not written. Returns their contents keyed by item id,
+    and the number of requests written.
+    """
+    answered = {}
+    written = set()
+    with open(requests_path, 'w', encoding='utf-8') as f:
+        for item in dataset:
+            custom_id = item_id(item)
+            if custom_id in written or custom_id in answered:
+                continue
+            prompt, data = build_request(item)
+            content = cache.get(MODEL, prompt) if cache is not None else None
+            if content is not None:
+                answered[custom_id] = content
+                continue
+            f.write(json.dumps({"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": data},
+                               ensure_ascii=False) + "\n")
+            written.add(custom_id)
+    print(f"Wrote {len(written)} batch requests to {requests_path} ({len(answered)} answered from cache)")
+    return answered, len(written)
+
+def run_batch(requests_path, output_path, batch_id=None, poll_interval=BATCH_POLL_INTERVAL):
+    """
+    Submit requests_path as a batch job (or follow batch_id if already submitted), poll it until it
+    finishes and download its output to output_path. Returns False if the batch produced no output.
+    """
+    client = OpenAI()
+    if batch_id is None:
+        with open(requests_path, 'rb') as f:
+            input_file = client.files.create(file=f, purpose="batch")
+        batch = client.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT,
+                                      completion_window=BATCH_COMPLETION_WINDOW)
+        print(f"Submitted batch {batch.id}")
+    else:
+        batch = client.batches.retrieve(batch_id)
+    while batch.status not in BATCH_FINAL_STATUSES:
+        time.sleep(poll_interval)
+        batch = client.batches.retrieve(batch.id)
+        counts = batch.request_counts
+        print(f"Batch {batch.id}: {batch.status}" + (f" ({counts.completed}/{counts.total})" if counts else ""))
+    if batch.output_file_id is None:
+        print(f"Batch {batch.id} ended with status {batch.status} and no output")
+        return False
+    with open(output_path, 'w', encoding='utf-8') as f:
+        f.write(client.files.content(batch.output_file_id).text)
+    return True
+
+def read_batch_output(output_path):
+    """
+    Map custom ids to the completion contents of the successful lines of a batch output file
+    """
+    contents = {}
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                response = record["response"]
+                if response["status_code"] == 200:
+                    contents[record["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+            except (ValueError, KeyError, IndexError, TypeError):
+                continue
+    return contents
+
+def merge_batch_output(dataset, contents, cache=None):
+    """
+    Attach batch contents to the dataset items by item id.
+    Items without content, or whose reasoning fails validate_reasoning, are left as None.
+    """
+    results = []
+    for item in dataset:
+        content = contents.get(item_id(item))
+        if content is None or validate_reasoning(content, item["VQL"]):
+            results.append(None)
+            continue
+        if cache is not None:
+            cache.put(MODEL, build_request(item)[0], content)
+        new_item = item.copy()
+        new_item["reasoning_content"] = content
+        results.append(new_item)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate CoT reasoning for nvBench items")
+    parser.add_argument("--input", default="processed_nvbench.json")
+    parser.add_argument("--output", default="processed_nvbench_with_reasoning.json")
+    parser.add_argument("--progress", default="processed_nvbench_with_reasoning.jsonl",
+                        help="JSONL file receiving each result as soon as it completes")
+    parser.add_argument("--cache", default=RESPONSE_CACHE_PATH, help="local cache of API responses")
+    parser.add_argument("--cache-max-mb", type=int, default=RESPONSE_CACHE_MAX_BYTES >> 20)
+    parser.add_argument("--no-cache", action="store_true", help="always send requests to the API")
+    parser.add_argument("--resume", action="store_true", help="skip items already in --progress with valid reasoning")
+    parser.add_argument("--overwrite", action="store_true", help="replace a non-empty --progress file")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--mode", choices=["online", "batch"], default="online",
+                        help="send one request per item, or submit all prompts as a provider batch job")
+    parser.add_argument("--batch-requests", default="processed_nvbench_batch_requests.jsonl",
+                        help="batch job input file written in batch mode")
+    parser.add_argument("--batch-output", default="processed_nvbench_batch_output.jsonl",
+                        help="batch job output file; merged as is when it already exists")
+    parser.add_argument("--batch-id", default=None, help="follow an already submitted batch job")
+    parser.add_argument("--poll-interval", type=float, default=BATCH_POLL_INTERVAL)
+    parser.add_argument("--regeneration-rounds", type=int, default=REGENERATION_ROUNDS,
+                        help="times items with reasoning that fails validation are regenerated")
+    parser.add_argument("--rpm", type=int, default=REQUESTS_PER_MINUTE, help="requests per minute allowed by the API quota")
+    parser.add_argument("--tpm", type=int, default=TOKENS_PER_MINUTE, help="tokens per minute allowed by the API quota")
+    args = parser.parse_args()
+
+    dataset = load_records(args.input)
+
+    cache = None if args.no_cache else ResponseCache(args.cache, args.cache_max_mb << 20)
+    limiter = RateLimiter(args.rpm, args.tpm)
+    if args.mode == "batch":
+        contents, num_requests = write_batch_requests(dataset, args.batch_requests, cache)
+        if num_requests == 0 and args.batch_id is None:
+            # Every prompt is answered from the cache, there is no batch to submit
+            print("All prompts answered from cache, skipping the batch job")
+        else:
+            if os.path.exists(args.batch_output) and args.batch_id is None:
+                print(f"Merging existing batch output {args.batch_output}")
+            else:
+                run_batch(args.batch_requests, args.batch_output, args.batch_id, args.poll_interval)
+            if os.path.exists(args.batch_output):
+                contents.update(read_batch_output(args.batch_output))
+        new_dataset = merge_batch_output(dataset, contents, cache)
+        # Items the batch did not answer correctly fall back to online requests
+        missing = [i for i, new_item in enumerate(new_dataset) if new_item is None]
+        if missing:
+            print(f"Falling back to online requests for {len(missing)} items")
+            fallback = asyncio.run(process_dataset([dataset[i] for i in missing], args.concurrency, limiter,
+                                                   cache=cache, regeneration_rounds=args.regeneration_rounds))
+            for i, new_item in zip(missing, fallback):
+                new_dataset[i] = new_item
+    else:
+        try:
+            new_dataset = asyncio.run(process_dataset(dataset, args.concurrency, limiter, args.progress, args.resume,
+                                                      cache, args.regeneration_rounds, args.overwrite))
+        except FileExistsError as e:
+            print(e)
+            exit(1)
+    if cache is not None:
+        print(cache.stats())
+        cache.close()
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(new_dataset, f, ensure_ascii=False, indent=4)
 
-with open('processed_nvbench_with_reasoning.json', 'w', encoding='utf-8') as f:
-    json.dump(new_dataset, f, ensure_ascii=False, indent=4)
+if __name__ == "__main__":
+    main()
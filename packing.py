@@ -0,0 +1,204 @@
+import numpy as np
+import torch
+
+# Label ignored by the loss
+IGNORE_INDEX = -100
+
+def first_fit_decreasing(lengths, capacity):
+    """
+    Assign items to bins of the given capacity with first-fit-decreasing: items are taken from longest
+    to shortest and each goes into the first bin with enough room.
+    Returns the list of bins, each a list of item indices.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    # Segment tree over the bins holding the maximum remaining space of each subtree,
+    # so the first bin with enough room is found in O(log n)
+    size = 1
+    while size < max(len(lengths), 1):
+        size *= 2
+    tree = [capacity] * (2 * size)
+    bins = []
+    for i in order:
+        length = lengths[i]
+        if length > capacity:
+            raise ValueError(f"item {i} of length {length} does not fit in capacity {capacity}")
+        node = 1
+        while node < size:
+            node = 2 * node if tree[2 * node] >= length else 2 * node + 1
+        b = node - size
+        if b == len(bins):
+            bins.append([])
+        bins[b].append(i)
+        tree[node] -= length
+        node //= 2
+        while node:
+            tree[node] = max(tree[2 * node], tree[2 * node + 1])
+            node //= 2
+    return bins
+
+def gather_bins(batch, examples):
+    """
+    Concatenate the examples of each bin into one sequence whose position_ids restart at 0
+    at every example, which marks the attention boundaries between them
+    """
+    input_ids, position_ids = [], []
+    for bin_ in batch["bin"]:
+        rows = examples[bin_]["input_ids"]
+        input_ids.append([token for ids in rows for token in ids])
+        position_ids.append([position for ids in rows for position in range(len(ids))])
+    return {"input_ids": input_ids, "position_ids": position_ids}
+
+def pack_dataset(dataset, max_seq_length, num_proc=None):
+    """
+    Pack a tokenized dataset (input_ids column) into sequences of at most max_seq_length tokens
+    with first-fit-decreasing. Returns the packed dataset and a report of the packing.
+    """
+    from datasets import Dataset
+
+    lengths = [len(ids) for ids in dataset["input_ids"]]
+    bins = first_fit_decreasing(lengths, max_seq_length)
+    packed = Dataset.from_dict({"bin": bins}).map(
+        gather_bins, batched=True, batch_size=100, num_proc=num_proc, fn_kwargs={"examples": dataset},
+        remove_columns=["bin"], desc="Packing")
+    return packed, packing_report(lengths, bins, max_seq_length)
+
+def split_examples(batch):
+    """
+    Split packed sequences back into their examples at the positions where position_ids restart
+    """
+    input_ids, lengths = [], []
+    for ids, positions in zip(batch["input_ids"], batch["position_ids"]):
+        starts = [i for i, position in enumerate(positions) if position == 0] + [len(positions)]
+        for start, end in zip(starts, starts[1:]):
+            input_ids.append(ids[start:end])
+            lengths.append(end - start)
+    return {"input_ids": input_ids, "length": lengths}
+
+def unpack_dataset(dataset, num_proc=None):
+    """
+    One example per row of a packed dataset, with the length column read by
+    TrainingArguments(group_by_length=True) to batch examples of similar length
+    """
+    return dataset.map(split_examples, batched=True, num_proc=num_proc, remove_columns=dataset.column_names,
+                       desc="Unpacking")
+
+def packing_report(lengths, bins, max_seq_length):
+    """
+    Length distribution of the examples and share of the packed sequences filled with real tokens
+    """
+    lengths = np.asarray(lengths)
+    return {
+        "examples": len(lengths),
+        "sequences": len(bins),
+        "tokens": int(lengths.sum()),
+        "length_p50": int(np.percentile(lengths, 50)) if len(lengths) else 0,
+        "length_p90": int(np.percentile(lengths, 90)) if len(lengths) else 0,
+        "length_p99": int(np.percentile(lengths, 99)) if len(lengths) else 0,
+        "length_max": int(lengths.max()) if len(lengths) else 0,
+        "efficiency": float(lengths.sum() / (len(bins) * max_seq_length)) if bins else 0.0,
+        "unpacked_efficiency": float(lengths.mean() / lengths.max()) if len(lengths) else 0.0,
+    }
+
+def print_packing_report(report):
+    print(f"Packed {report['examples']} examples ({report['tokens']} tokens) into {report['sequences']} sequences")
+    print(f"Example length p50/p90/p99/max: {report['length_p50']}/{report['length_p90']}/"
+          f"{report['length_p99']}/{report['length_max']}")
+    print(f"Packing efficiency: {report['efficiency']:.2%} "
+          f"(padding to the longest example: {report['unpacked_efficiency']:.2%})")
+
+def collate_packed(features, dtype=torch.float32, pad_token_id=0):
+    """
+    Batch packed sequences, one per row, right-padded to the longest row. Each row gets a block-diagonal
+    causal attention mask (4D, additive, in the model dtype) so that a token only attends to earlier tokens
+    of its own example, position_ids restarting at every example, and labels that ignore padding and the
+    first token of every example, which would otherwise be predicted from the previous example.
+    """
+    batch_size = len(features)
+    length = max(len(feature["input_ids"]) for feature in features)
+    input_ids = torch.full((batch_size, length), pad_token_id, dtype=torch.long)
+    position_ids = torch.zeros((batch_size, length), dtype=torch.long)
+    labels = torch.full((batch_size, length), IGNORE_INDEX, dtype=torch.long)
+    # Padding positions only attend to themselves, a fully masked row would turn into NaNs
+    allowed = torch.eye(length, dtype=torch.bool).repeat(batch_size, 1, 1)
+    causal = torch.ones((length, length), dtype=torch.bool).tril()
+    for row, feature in enumerate(features):
+        n = len(feature["input_ids"])
+        ids = torch.tensor(feature["input_ids"], dtype=torch.long)
+        positions = torch.tensor(feature["position_ids"], dtype=torch.long)
+        input_ids[row, :n] = ids
+        position_ids[row, :n] = positions
+        labels[row, :n] = ids.masked_fill(positions == 0, IGNORE_INDEX)
+        example = (positions == 0).cumsum(0)
+        allowed[row, :n, :n] = (example[:, None] == example[None, :]) & causal[:n, :n]
+    attention_mask = torch.zeros((batch_size, 1, length, length), dtype=dtype)
+    attention_mask.masked_fill_(~allowed[:, None], torch.finfo(dtype).min)
+    return {
+        "input_ids": input_ids,
+        "position_ids": position_ids,
+        "attention_mask": attention_mask,
+        "labels": labels,
+    }
+
+def collate_flattened(features):
+    """
+    Batch packed sequences as a single row, without padding or attention mask: examples are only separated
+    by their position_ids restarting at 0, which the flash-attention varlen path (padding-free training, as
+    with transformers' DataCollatorWithFlattening) turns into sequence boundaries. Labels ignore the first
+    token of every example.
+    """
+    input_ids = torch.tensor([[token for feature in features for token in feature["input_ids"]]], dtype=torch.long)
+    position_ids = torch.tensor([[position for feature in features for position in feature["position_ids"]]],
+                                dtype=torch.long)
+    return {
+        "input_ids": input_ids,
+        "position_ids": position_ids,
+        "labels": input_ids.masked_fill(position_ids == 0, IGNORE_INDEX),
+    }
+
+def collate_padded(features, pad_token_id=0):
+    """
+    Batch unpacked examples, one per row, right-padded to the longest row. Padding is excluded from the
+    labels, and right padding leaves the real tokens untouched even by a model that ignores the padding
+    mask, since causal attention never looks ahead.
+    """
+    batch_size = len(features)
+    length = max(len(feature["input_ids"]) for feature in features)
+    input_ids = torch.full((batch_size, length), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((batch_size, length), dtype=torch.long)
+    labels = torch.full((batch_size, length), IGNORE_INDEX, dtype=torch.long)
+    for row, feature in enumerate(features):
+        n = len(feature["input_ids"])
+        ids = torch.tensor(feature["input_ids"], dtype=torch.long)
+        input_ids[row, :n] = ids
+        attention_mask[row, :n] = 1
+        labels[row, :n] = ids
+    return {
+        "input_ids": input_ids,
+        "attention_mask": attention_mask,
+        "labels": labels,
+    }
+
+def isolation_error(model, collate, vocab_size, length=64, seed=0):
+    """
+    Check that the model honours the attention mask of collate. The same random tokens are packed twice in
+    one sequence: if the second copy can see the first, the model predicts it by copying and its loss
+    drops far below the loss of the copy on its own. Returns the absolute difference of the two losses.
+    The model runs in training mode with gradients enabled, as in the training steps, since some
+    implementations (unsloth among them) drop the attention mask in training mode only.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    tokens = torch.randint(vocab_size, (length,), generator=generator).tolist()
+    positions = list(range(length))
+    packed = collate([{"input_ids": tokens + tokens, "position_ids": positions + positions}])
+    # Only the second copy is scored
+    packed["labels"][0, :length] = IGNORE_INDEX
+    alone = collate([{"input_ids": tokens, "position_ids": positions}])
+    device = next(model.parameters()).device
+    training = model.training
+    model.train()
+    try:
+        losses = [model(**{key: value.to(device) for key, value in batch.items()}).loss.item()
+                  for batch in (packed, alone)]
+    finally:
+        model.train(training)
+    return abs(losses[0] - losses[1])
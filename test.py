@@ -1,28 +1,97 @@
+import os
+import re
+import copy
+import sys
 import json
+import hashlib
+import argparse
+import subprocess
+import numpy as np
+import torch
 from unsloth import FastLanguageModel, is_bfloat16_supported
-from transformers import TextStreamer
+from transformers import AutoTokenizer, TextStreamer, StoppingCriteria, StoppingCriteriaList, DynamicCache
+from transformers import AutoModelForCausalLM, BitsAndBytesConfig
 from peft import PeftModel
 from tqdm import tqdm
+from data_loader import iter_records, hash_file, open_records_file
 import pandas as pd
 SAVED_MODEL_FOLDER ="your model path"
 SAVED_ADAPTER_FOLDER="your checkpoint path"
-def deep_dict_to_json(obj):
-    if isinstance(obj, dict):
-        return {key: deep_dict_to_json(value) for key, value in obj.items()}
-    elif isinstance(obj, list):
-        return [deep_dict_to_json(item) for item in obj]
-    else:
-        return obj
+# Prompts generated together; lower it if generation runs out of memory
+BATCH_SIZE = 16
+# Upper bound of max_new_tokens, which is otherwise derived from the content_2 lengths of the training data
+MAX_NEW_TOKENS = 4048
+TRAIN_DATA_PATH = "CoT-nvBench/train.json"
+TEST_DATA_PATH = "CoT-nvBench/test.json"
+# Per-shard results of the sharded runner
+SHARD_DIR = "test_shards"
+MAX_NEW_TOKENS_PERCENTILE = 99.5
+MAX_NEW_TOKENS_MARGIN = 1.25
+# Key of the schema in content_1, moved first so that prompts on the same database share a prefix
+SCHEMA_KEY = "Database Schema"
+# Shared prefixes shorter than this are not worth a cached prefill, those prompts are generated in batches
+MIN_SHARED_PREFIX_TOKENS = 64
+# Generated tokens decoded at each step to look for the end of the Final VQL line
+STOP_WINDOW_TOKENS = 256
+# "Final VQL:" followed by a statement and the end of its line. The responses are JSON-encoded strings,
+# so the line can also end with an escaped \n or the closing quote (quotes inside the VQL are escaped).
+_FINAL_VQL_LINE_PATTERN = re.compile(r'Final VQL:(?:\s|\\n)*"?[^\s"\\](?:\\"|[^\n"])*?(?:\n|\\n|(?<!\\)")', re.IGNORECASE)
 
 def load_json_data(filename: str):
-    data = []
-    with open(filename, 'r') as file:
-        test_data = json.load(file)
-        for json_obj in test_data:
-            json_obj = deep_dict_to_json(json_obj)
-            json_obj = json.dumps(json_obj, ensure_ascii=False, indent=4)
-            data.append(json.loads(json_obj))
-    return data
+    """
+    Stream the records of a JSON array or JSONL file
+    """
+    return iter_records(filename)
+
+class FinalVQLStoppingCriteria(StoppingCriteria):
+    """
+    Stop each sequence of a batch once its Final VQL line is complete, since evaluation.py
+    ignores everything after it
+    """
+    def __init__(self, tokenizer, prompt_length, window=STOP_WINDOW_TOKENS):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.window = window
+        self.done = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.done is None:
+            self.done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        start = max(self.prompt_length, input_ids.shape[1] - self.window)
+        pending = (~self.done).nonzero().flatten().tolist()
+        texts = self.tokenizer.batch_decode(input_ids[pending, start:], skip_special_tokens=True)
+        for row, text in zip(pending, texts):
+            if _FINAL_VQL_LINE_PATTERN.search(text):
+                self.done[row] = True
+        return self.done.clone()
+
+def derive_max_new_tokens(tokenizer, data_path=TRAIN_DATA_PATH, percentile=MAX_NEW_TOKENS_PERCENTILE,
+                          margin=MAX_NEW_TOKENS_MARGIN, upper_bound=MAX_NEW_TOKENS):
+    """
+    Cap on the generated tokens from the token lengths of the training responses (content_2, JSON-encoded
+    as in train.py): the given percentile with a safety margin, at most upper_bound.
+    Without the training data, upper_bound is used.
+    """
+    if not os.path.exists(data_path):
+        print(f"{data_path} not found, using max_new_tokens {upper_bound}")
+        return upper_bound
+    texts = [json.dumps(item["content_2"], ensure_ascii=False) for item in iter_records(data_path)]
+    if not texts:
+        return upper_bound
+    lengths = [len(ids) for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]]
+    max_new_tokens = min(int(np.percentile(lengths, percentile) * margin), upper_bound)
+    print(f"content_2 tokens p50/p{percentile}/max: {int(np.percentile(lengths, 50))}/"
+          f"{int(np.percentile(lengths, percentile))}/{max(lengths)}, max_new_tokens: {max_new_tokens}")
+    return max_new_tokens
+
+def resolve_max_new_tokens(max_new_tokens=None):
+    """
+    max_new_tokens when given, otherwise derived from the training data with the model's tokenizer,
+    which is loaded on its own so that the model does not need to be
+    """
+    if max_new_tokens is not None:
+        return max_new_tokens
+    return derive_max_new_tokens(AutoTokenizer.from_pretrained(SAVED_MODEL_FOLDER))
 
 def extract_content_1(data):
     return data.get('content_1', {})
@@ -47,42 +116,364 @@ def load_model(with_lora: bool = True):
 
     return model, tokenizer
 
-def generate_responses(model, tokenizer, prompt):
-    inputs = tokenizer.apply_chat_template(
-        [prompt],
-        tokenize=True,
-        add_generation_prompt=True,
-        return_tensors="pt",
-    )
+def load_plain_model(with_lora: bool = True):
+    """
+    Load the model like load_model, in 4 bits on a GPU, but with plain transformers and PEFT, so that its
+    forward and generate keep the KV-cache handling the shared schema prefix relies on
+    """
+    tokenizer = AutoTokenizer.from_pretrained(SAVED_MODEL_FOLDER)
+    if torch.cuda.is_available():
+        dtype = torch.bfloat16 if is_bfloat16_supported() else torch.float16
+        quantization_config = BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_quant_type="nf4",
+                                                 bnb_4bit_use_double_quant=True, bnb_4bit_compute_dtype=dtype)
+        model = AutoModelForCausalLM.from_pretrained(SAVED_MODEL_FOLDER, torch_dtype=dtype,
+                                                     quantization_config=quantization_config, device_map="auto")
+    else:
+        model = AutoModelForCausalLM.from_pretrained(SAVED_MODEL_FOLDER)
+    print("Pad token:", tokenizer.pad_token)
+    print("EOS token:", tokenizer.eos_token)
+
+    if with_lora:
+        model = PeftModel.from_pretrained(model, SAVED_ADAPTER_FOLDER)
+    model.eval()
+
+    return model, tokenizer
+
+def iter_responses(model, tokenizer, prompts, batch_size=BATCH_SIZE, max_new_tokens=MAX_NEW_TOKENS):
+    """
+    Generate the responses of a list of prompts in batches, yielding (prompt index, response) pairs
+    as each batch finishes. Prompts are grouped by tokenized length to limit padding and left-padded
+    so that generation continues right after every prompt.
+    """
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    input_ids = [
+        tokenizer.apply_chat_template([prompt], tokenize=True, add_generation_prompt=True)
+        for prompt in prompts
+    ]
+    # Longest first, so that running out of memory happens on the first batch
+    order = sorted(range(len(prompts)), key=lambda i: len(input_ids[i]), reverse=True)
+    device = next(model.parameters()).device
+
+    for start in tqdm(range(0, len(order), batch_size), desc="Generating batches"):
+        batch = order[start:start + batch_size]
+        inputs = tokenizer.pad({"input_ids": [input_ids[i] for i in batch]}, return_tensors="pt").to(device)
+        # Sequences that reach an EOS token or finish their Final VQL line are padded until the whole batch is done
+        stopping_criteria = StoppingCriteriaList([FinalVQLStoppingCriteria(tokenizer, inputs["input_ids"].shape[1])])
+        outputs = model.generate(**inputs, max_new_tokens=max_new_tokens, use_cache=True, temperature=0.1,
+                                 pad_token_id=tokenizer.pad_token_id, stopping_criteria=stopping_criteria)
+        yield from zip(batch, tokenizer.batch_decode(outputs, skip_special_tokens=True))
+
+def schema_first(content_1):
+    """
+    content_1 with the database schema moved before the question, so that the prompts of a database
+    start with the same tokens. Contents without a schema field are returned unchanged.
+    """
+    if not isinstance(content_1, dict) or SCHEMA_KEY not in content_1:
+        return content_1
+    return {SCHEMA_KEY: content_1[SCHEMA_KEY], **{k: v for k, v in content_1.items() if k != SCHEMA_KEY}}
+
+def common_prefix_length(sequences):
+    shortest = min(sequences, key=len)
+    for i, token in enumerate(shortest):
+        if any(sequence[i] != token for sequence in sequences):
+            return i
+    return len(shortest)
+
+def is_unsloth_patched(model):
+    """
+    Whether unsloth replaced the forward or generate of the model, e.g. with FastLanguageModel.for_inference
+    """
+    base = model.get_base_model() if hasattr(model, "get_base_model") else model
+    functions = [type(base).forward, base.forward, getattr(base, "generate", None), getattr(model, "generate", None)]
+    return any((getattr(function, "__module__", None) or "").startswith("unsloth") for function in functions)
+
+def iter_responses_shared_prefix(model, tokenizer, prompts, db_ids, max_new_tokens=MAX_NEW_TOKENS):
+    """
+    Generate responses reusing the prefill of the prefix shared by the prompts of each db_id: the
+    past_key_values of the common tokens are computed once per database, and each question is generated
+    from a copy of them, so only its own tokens are prefilled. The shared prefix is taken from the
+    tokenized prompts, so it never splits a token differently than the full prompts do. Databases with
+    a single question or a prefix shorter than MIN_SHARED_PREFIX_TOKENS go through iter_responses.
+    The model must not be patched by unsloth (see load_plain_model), since its fast inference path has its
+    own KV-cache handling that this has not been checked against. Yields (prompt index, response) pairs.
+    """
+    if is_unsloth_patched(model):
+        raise ValueError("The shared schema prefix needs a model not patched by unsloth, see load_plain_model")
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    groups = {}
+    for i, db_id in enumerate(db_ids):
+        groups.setdefault(db_id, []).append(i)
     device = next(model.parameters()).device
-    inputs = inputs.to(device)
 
-    response = model.generate(input_ids=inputs, max_new_tokens=4048, use_cache=True, temperature=0.1)
- 
-    response_txt = tokenizer.decode(response[0], skip_special_tokens=True)
-    return response_txt
+    fallback = []
+    for db_id, indices in tqdm(groups.items(), desc="Generating databases"):
+        input_ids = [
+            tokenizer.apply_chat_template([prompts[i]], tokenize=True, add_generation_prompt=True)
+            for i in indices
+        ]
+        # Keep at least one token of every prompt out of the cache, generate needs it to start
+        prefix_length = min(common_prefix_length(input_ids), min(map(len, input_ids)) - 1)
+        if len(indices) < 2 or prefix_length < MIN_SHARED_PREFIX_TOKENS:
+            fallback.extend(indices)
+            continue
+
+        with torch.no_grad():
+            prefix = torch.tensor([input_ids[0][:prefix_length]], device=device)
+            prefix_cache = model(input_ids=prefix, past_key_values=DynamicCache(), use_cache=True).past_key_values
+        for i, ids in zip(indices, input_ids):
+            inputs = torch.tensor([ids], device=device)
+            stopping_criteria = StoppingCriteriaList([FinalVQLStoppingCriteria(tokenizer, inputs.shape[1])])
+            output = model.generate(input_ids=inputs, attention_mask=torch.ones_like(inputs),
+                                    past_key_values=copy.deepcopy(prefix_cache), max_new_tokens=max_new_tokens,
+                                    use_cache=True, temperature=0.1, pad_token_id=tokenizer.pad_token_id,
+                                    stopping_criteria=stopping_criteria)
+            yield i, tokenizer.decode(output[0], skip_special_tokens=True)
+
+    if fallback:
+        print(f"{len(fallback)} prompts without a shared schema prefix, generating them in batches")
+        fallback_prompts = [prompts[i] for i in fallback]
+        for j, response in iter_responses(model, tokenizer, fallback_prompts, max_new_tokens=max_new_tokens):
+            yield fallback[j], response
+
+def shard_indices(num_items, num_shards, shard):
+    """
+    Item indices of a shard. Items are dealt round-robin, so shards are deterministic and get a similar mix of lengths.
+    """
+    return list(range(shard, num_items, num_shards))
+
+def shard_indices_by_db(db_ids, num_shards, shard):
+    """
+    Item indices of a shard keeping the items of a db_id together, so they can share their schema prefix.
+    Databases are assigned largest first to the least loaded shard, which is deterministic for a given dataset.
+    """
+    groups = {}
+    for i, db_id in enumerate(db_ids):
+        groups.setdefault(str(db_id), []).append(i)
+    loads = [0] * num_shards
+    indices = []
+    for db_id in sorted(groups, key=lambda db_id: (-len(groups[db_id]), db_id)):
+        target = loads.index(min(loads))
+        loads[target] += len(groups[db_id])
+        if target == shard:
+            indices.extend(groups[db_id])
+    return sorted(indices)
+
+def shard_path(shard_dir, shard, num_shards):
+    return os.path.join(shard_dir, f"shard_{shard:03d}_of_{num_shards:03d}.jsonl")
+
+def path_signature(path):
+    """
+    Signature of a local model or adapter: its path and the name, size and modification time of its files,
+    which changes when a checkpoint is retrained in place. Hub names are used as they are.
+    """
+    files = []
+    if os.path.isdir(path):
+        for root, _, names in os.walk(path):
+            for name in names:
+                stat = os.stat(os.path.join(root, name))
+                files.append([os.path.relpath(os.path.join(root, name), path), stat.st_size, stat.st_mtime_ns])
+    elif os.path.isfile(path):
+        stat = os.stat(path)
+        files.append([os.path.basename(path), stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha256(json.dumps([os.path.abspath(path) if files else path, sorted(files)]).encode('utf-8')).hexdigest()
+
+def shard_fingerprint(data_path, share_schema_prefix, max_new_tokens):
+    """
+    Everything the responses of a shard depend on; stored as the first line of its file
+    """
+    return {
+        "model": path_signature(SAVED_MODEL_FOLDER),
+        "adapter": path_signature(SAVED_ADAPTER_FOLDER),
+        "data": hash_file(data_path),
+        "share_schema_prefix": share_schema_prefix,
+        "max_new_tokens": max_new_tokens,
+    }
+
+def load_shard(path):
+    """
+    Fingerprint and results, keyed by item index, of a shard file; a truncated last line from an
+    interrupted run is skipped. The fingerprint is None for a missing file or one without header.
+    """
+    fingerprint, results = None, {}
+    if not os.path.exists(path):
+        return fingerprint, results
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if "fingerprint" in record:
+                fingerprint = record["fingerprint"]
+            else:
+                results[record["index"]] = record
+    return fingerprint, results
+
+def run_shard(data_path, shard, num_shards, shard_dir=SHARD_DIR, share_schema_prefix=False, max_new_tokens=None):
+    """
+    Generate the responses of one shard, appending one JSONL line per item with its index in the dataset.
+    Items already in the shard file are skipped, so a failed shard restarts where it stopped, as long as
+    the file was written with the same model, adapter, test set and settings (see shard_fingerprint);
+    otherwise the shard starts over.
+    With share_schema_prefix, the model is loaded with load_plain_model, and prompts put the schema first
+    and reuse its prefill per db_id.
+    max_new_tokens is derived from the training data when not given, see resolve_max_new_tokens.
+    """
+    path = shard_path(shard_dir, shard, num_shards)
+    max_new_tokens = resolve_max_new_tokens(max_new_tokens)
+    fingerprint = shard_fingerprint(data_path, share_schema_prefix, max_new_tokens)
+    found, done = load_shard(path)
+    resume = found == fingerprint
+    if not resume:
+        if found is not None or done:
+            print(f"{path} was generated with another model, adapter, test set or settings, starting over")
+        done = {}
+    # The test set is streamed twice: once for the db_ids the shards are assigned from,
+    # then for the contents of the items this shard still has to generate
+    db_ids = [item.get("db_id") for item in load_json_data(data_path)]
+    if share_schema_prefix:
+        indices = shard_indices_by_db(db_ids, num_shards, shard)
+    else:
+        indices = shard_indices(len(db_ids), num_shards, shard)
+    indices = [i for i in indices if i not in done]
+    print(f"Shard {shard}/{num_shards}: {len(indices)} items to generate, {len(done)} already done")
+    if not indices:
+        return
+
+    pending = set(indices)
+    contents = {i: extract_content_1(item) for i, item in enumerate(load_json_data(data_path)) if i in pending}
+    if share_schema_prefix:
+        model_lora, tokenizer_lora = load_plain_model(with_lora=True)
+        # Checked before anything is written, the shard and its prompts were laid out for the shared prefix
+        if is_unsloth_patched(model_lora):
+            raise RuntimeError("--share-schema-prefix needs a model not patched by unsloth, "
+                               "but the transformers model classes are; rerun without it")
+    else:
+        model_lora, tokenizer_lora = load_model(with_lora=True)
+    if share_schema_prefix:
+        prompts = [generate_input(schema_first(contents[i])) for i in indices]
+    else:
+        prompts = [generate_input(contents[i]) for i in indices]
+    os.makedirs(shard_dir, exist_ok=True)
+    with open_records_file(path, append=resume) as f:
+        if not resume:
+            f.write(json.dumps({"fingerprint": fingerprint}) + '\n')
+            f.flush()
+        if share_schema_prefix:
+            responses = iter_responses_shared_prefix(model_lora, tokenizer_lora, prompts,
+                                                     [db_ids[i] for i in indices], max_new_tokens)
+        else:
+            responses = iter_responses(model_lora, tokenizer_lora, prompts, max_new_tokens=max_new_tokens)
+        for i, response_lora in responses:
+            result = {
+                "index": indices[i],
+                "prompt": prompts[i],
+                "response_finetuned_model": response_lora,
+            }
+            f.write(json.dumps(result) + '\n')
+            f.flush()
+
+def launch_shards(data_path, num_shards, shard_dir=SHARD_DIR, devices=None, shards=None, share_schema_prefix=False,
+                  max_new_tokens=None):
+    """
+    Run shards in parallel, each in its own process running this script with --shard,
+    pinned to one of the devices (CUDA_VISIBLE_DEVICES) round-robin, or sharing the CPU threads when
+    there are no devices. Returns the shards that failed.
+    """
+    shards = range(num_shards) if shards is None else shards
+    processes = {}
+    for shard in shards:
+        env = dict(os.environ)
+        if devices:
+            env["CUDA_VISIBLE_DEVICES"] = devices[shard % len(devices)]
+        else:
+            env["OMP_NUM_THREADS"] = str(max(1, (os.cpu_count() or 1) // num_shards))
+        command = [sys.executable, os.path.abspath(__file__), "--data", data_path, "--num-shards", str(num_shards),
+                   "--shard", str(shard), "--shard-dir", shard_dir]
+        if share_schema_prefix:
+            command.append("--share-schema-prefix")
+        if max_new_tokens is not None:
+            command.extend(["--max-new-tokens", str(max_new_tokens)])
+        processes[shard] = subprocess.Popen(command, env=env)
+    failed = [shard for shard, process in processes.items() if process.wait() != 0]
+    if failed:
+        print(f"Failed shards: {failed}; rerun them with --shard")
+    return failed
+
+def merge_shards(data_path, num_shards, output_path, shard_dir=SHARD_DIR):
+    """
+    Merge the shard files into the JSON list of {"prompt", "response_finetuned_model"} read by
+    evaluation.py, in the order of the dataset. Shards must all have been generated with the same settings,
+    and with the current model, adapter and test set; others count as missing.
+    Returns the indices missing from the shards.
+    """
+    num_items = sum(1 for _ in load_json_data(data_path))
+    expected = shard_fingerprint(data_path, None, None)
+    merged = {}
+    fingerprints = []
+    for shard in range(num_shards):
+        path = shard_path(shard_dir, shard, num_shards)
+        fingerprint, results = load_shard(path)
+        if fingerprint is None or any(fingerprint[key] != expected[key] for key in ("model", "adapter", "data")):
+            if os.path.exists(path):
+                print(f"{path} was generated with another model, adapter or test set, ignoring it")
+            continue
+        fingerprints.append(fingerprint)
+        merged.update(results)
+    if any(fingerprint != fingerprints[0] for fingerprint in fingerprints):
+        print("Shards were generated with different settings, not merging")
+        return list(range(num_items))
+    missing = [i for i in range(num_items) if i not in merged]
+    if missing:
+        print(f"{len(missing)} items missing from the shards, not merging")
+        return missing
+
+    results = [
+        {"prompt": merged[i]["prompt"], "response_finetuned_model": merged[i]["response_finetuned_model"]}
+        for i in range(num_items)
+    ]
+    with open(output_path, 'w') as json_file:
+        json.dump(results, json_file, indent=4)
+    print(f"Results saved to {output_path}")
+    return missing
 
 def main():
-    # Load JSON data
-    json_data = load_json_data("CoT-nvBench/test.json")
-
-    model_lora, tokenizer_lora = load_model(with_lora=True)
-    results = []
-    for item in tqdm(json_data, desc="Processing items"):
-        content_1 = extract_content_1(item)
-        prompt = generate_input(content_1)
-        result = {
-            "prompt": prompt,
-            "response_finetuned_model": response_lora,
-        }
-        results.append(result)
-
-    # Save results to a JSON file
     now = pd.Timestamp.now().strftime("%Y-%m-%d_%H-%M-%S")
-    with open(f"test_{now}.json", 'w') as json_file:
-        json.dump(results, json_file, indent=4)
+    parser = argparse.ArgumentParser(description="Generate the responses of the fine-tuned model on the test set")
+    parser.add_argument("--data", default=TEST_DATA_PATH, help="test set, JSON list or JSONL")
+    parser.add_argument("--output", default=f"test_{now}.json", help="merged results")
+    parser.add_argument("--num-shards", type=int, default=1, help="number of shards the test set is split into")
+    parser.add_argument("--shard", type=int, default=None,
+                        help="run only this shard in the current process, e.g. to restart a failed one")
+    parser.add_argument("--shard-dir", default=SHARD_DIR, help="directory of the per-shard JSONL files")
+    parser.add_argument("--devices", default=None,
+                        help="comma-separated CUDA devices shards are spread over (default: all visible GPUs)")
+    parser.add_argument("--merge", action="store_true", help="only merge the existing shard files")
+    parser.add_argument("--share-schema-prefix", action="store_true",
+                        help="put the schema first in the prompts and reuse its prefill for the questions of a db_id")
+    parser.add_argument("--max-new-tokens", type=int, default=None,
+                        help="cap on generated tokens (default: derived from the content_2 lengths of the training data)")
+    args = parser.parse_args()
 
-    print(f"Results saved to test_{now}.json")
+    if args.shard is not None:
+        run_shard(args.data, args.shard, args.num_shards, args.shard_dir, args.share_schema_prefix, args.max_new_tokens)
+        return
+    if not args.merge:
+        # Derived once here rather than in every shard process
+        max_new_tokens = resolve_max_new_tokens(args.max_new_tokens)
+        if args.devices is not None:
+            devices = args.devices.split(",")
+        else:
+            devices = [str(i) for i in range(torch.cuda.device_count())]
+        if args.num_shards == 1:
+            run_shard(args.data, 0, 1, args.shard_dir, args.share_schema_prefix, max_new_tokens)
+        else:
+            launch_shards(args.data, args.num_shards, args.shard_dir, devices,
+                          share_schema_prefix=args.share_schema_prefix, max_new_tokens=max_new_tokens)
+    merge_shards(args.data, args.num_shards, args.output, args.shard_dir)
 
 if __name__ == "__main__":
     main()
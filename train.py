@@ -1,9 +1,20 @@
+import os
+import math
+import argparse
+from functools import partial
 import torch
 import pandas as pd
 import json
+import shutil
+import hashlib
+import inspect
+import packing
 from collections import OrderedDict
 from trl import SFTTrainer
-from datasets import Dataset
+from datasets import load_from_disk
+from data_loader import load_dataset, hash_file
+from packing import pack_dataset, unpack_dataset, print_packing_report, collate_packed, collate_flattened, collate_padded, \
+    isolation_error
 from transformers import TrainingArguments
 from unsloth.chat_templates import get_chat_template
 from unsloth import FastLanguageModel, is_bfloat16_supported
@@ -11,7 +22,107 @@ from transformers import EarlyStoppingCallback
 from sageattention import sageattn
 from transformers import AutoTokenizer
 
+TRAIN_DATA_PATH = "CoT-nvBench/train.json"
+# Directory of the pre-tokenized datasets, one per cache key
+TOKENIZED_CACHE_DIR = "tokenized_cache"
+# Bumped when the preprocessing below changes in a way the cache key does not capture
+PREPROCESS_VERSION = 2
+NUM_PROC = os.cpu_count()
+# Largest loss difference (nats) accepted by the packing isolation check before training
+PACKING_ISOLATION_TOLERANCE = 0.1
+
+def apply_template(examples, tokenizer):
+    messages = []
+    for role_1, content_1, role_2, content_2 in zip(
+            examples["role_1"], examples["content_1"], examples["role_2"], examples["content_2"]):
+        content_1_str = json.dumps(content_1, ensure_ascii=False)
+        content_2_str = json.dumps(content_2, ensure_ascii=False)
+        messages.append([
+            {"role": role_1, "content": content_1_str},
+            {"role": role_2, "content": content_2_str}
+        ])
+
+    text = [
+        tokenizer.apply_chat_template(message, tokenize=False, add_generation_prompt=False) for message in messages
+    ]
+    return {"text": text}
+
+def tokenize(examples, tokenizer, max_seq_length):
+    # The chat template already starts with the BOS token; examples longer than a packed sequence are truncated
+    tokenized = tokenizer(examples["text"], add_special_tokens=False, truncation=True, max_length=max_seq_length - 1)
+    return {"input_ids": [ids + [tokenizer.eos_token_id] for ids in tokenized["input_ids"]]}
+
+def tokenized_cache_key(data_path, tokenizer, max_seq_length):
+    """
+    Hash of everything the tokenized dataset depends on: the tokenizer, the chat template,
+    the preprocessing code, the sequence length and the training data
+    """
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    tokenizer_state = backend.to_str() if backend is not None else json.dumps(tokenizer.get_vocab(), sort_keys=True)
+    sha256 = hashlib.sha256()
+    for part in [tokenizer_state, str(tokenizer.chat_template), str(tokenizer.eos_token_id),
+                 inspect.getsource(apply_template), inspect.getsource(tokenize), inspect.getsource(packing),
+                 str(max_seq_length), str(PREPROCESS_VERSION), hash_file(data_path)]:
+        sha256.update(part.encode('utf-8'))
+        sha256.update(b'\0')
+    return sha256.hexdigest()
+
+def build_tokenized_dataset(data_path, tokenizer, max_seq_length, cache_dir=TOKENIZED_CACHE_DIR, num_proc=NUM_PROC):
+    """
+    Template, tokenize and pack the training data once, and reuse the saved Arrow files,
+    which are memory-mapped, in the following runs with the same tokenizer and data.
+    Returns the packed dataset and its packing report.
+    """
+    cache_path = os.path.join(cache_dir, tokenized_cache_key(data_path, tokenizer, max_seq_length))
+    report_path = os.path.join(cache_path, "packing_report.json")
+    if os.path.isdir(cache_path):
+        print(f"Loading tokenized dataset from {cache_path}")
+        with open(report_path, 'r') as f:
+            return load_from_disk(cache_path), json.load(f)
+
+    dataset = load_dataset(data_path)
+    dataset = dataset.map(apply_template, batched=True, num_proc=num_proc, fn_kwargs={"tokenizer": tokenizer},
+                          remove_columns=dataset.column_names, desc="Applying template")
+    print(dataset[0]["text"])
+    dataset = dataset.map(tokenize, batched=True, num_proc=num_proc,
+                          fn_kwargs={"tokenizer": tokenizer, "max_seq_length": max_seq_length},
+                          remove_columns=["text"], desc="Tokenizing")
+    dataset, report = pack_dataset(dataset, max_seq_length, num_proc)
+
+    # Save under a temporary name first so an interrupted run does not leave a partial cache
+    tmp_path = cache_path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    dataset.save_to_disk(tmp_path)
+    with open(os.path.join(tmp_path, "packing_report.json"), 'w') as f:
+        json.dump(report, f, indent=4)
+    os.replace(tmp_path, cache_path)
+    print(f"Saved tokenized dataset to {cache_path}")
+    return load_from_disk(cache_path), report
+
+def select_packed_collator(model, pad_token_id, dtype, vocab_size):
+    """
+    First collator of packed sequences whose example boundaries the model honours in training mode, checked
+    with isolation_error: the block-diagonal attention mask, then position_ids alone in one flattened row
+    (padding-free varlen attention). Returns None when the model honours neither.
+    """
+    collators = [
+        ("block-diagonal attention mask", partial(collate_packed, dtype=dtype, pad_token_id=pad_token_id)),
+        ("position_ids in one flattened row", collate_flattened),
+    ]
+    for name, collator in collators:
+        error = isolation_error(model, collator, vocab_size)
+        print(f"Packing isolation check, {name}: loss difference {error:.4f}")
+        if error <= PACKING_ISOLATION_TOLERANCE:
+            return collator
+    return None
+
 def main():
+    parser = argparse.ArgumentParser(description="Fine-tune the model on the nvBench-CoT training set")
+    parser.add_argument("--unpacked", action="store_true",
+                        help="train on one example per row, batched by length, instead of packed sequences; "
+                             "each step then sees fewer tokens, so there are more steps and the LR schedule changes")
+    args = parser.parse_args()
+
     max_seq_length = 4048
     model, tokenizer = FastLanguageModel.from_pretrained(
         model_name="unsloth/Meta-Llama-3.1-8B-Instruct",
@@ -30,51 +141,31 @@ def main():
     )
 
 
-    def deep_dict_to_json(obj):
-        if isinstance(obj, dict):
-            return {key: deep_dict_to_json(value) for key, value in obj.items()}
-        elif isinstance(obj, list):
-            return [deep_dict_to_json(item) for item in obj]
-        else:
-            return obj
-          
-    data_train = []
-    with open("CoT-nvBench/train.json", "r") as file:
-        train_data = json.load(file)  
-        for json_obj in train_data:
-            json_obj=deep_dict_to_json(json_obj)
-            json_obj = json.dumps(json_obj, ensure_ascii=False, indent=4)
-            #print(json_obj)
-            data_train.append(json.loads(json_obj))
-   
-    df_train = pd.DataFrame(data_train)
-    
-    def apply_template(examples):
-        messages = []
-        for role_1, content_1, role_2, content_2 in zip(
-                examples["role_1"], examples["content_1"], examples["role_2"], examples["content_2"]):
-            content_1_str = json.dumps(content_1, ensure_ascii=False)
-            content_2_str = json.dumps(content_2, ensure_ascii=False)
-            messages.append([
-                {"role": role_1, "content": content_1_str},
-                {"role": role_2, "content": content_2_str}
-            ])
-
-        text = [
-            tokenizer.apply_chat_template(message, tokenize=False, add_generation_prompt=False) for message in messages
-        ]
-        return {"text": text}
-    dataset_train = Dataset.from_pandas(df_train) 
-    #dataset_train = dataset_train.shuffle(seed=42)
-    dataset_train = dataset_train.map(apply_template, batched=True)
-    print(dataset_train[0])
-    
-    total_samples = 11260
+    dataset_train, packing_report = build_tokenized_dataset(TRAIN_DATA_PATH, tokenizer, max_seq_length)
+
+    pad_token_id = tokenizer.pad_token_id or 0
+    if args.unpacked:
+        print("Training on unpacked examples batched by length")
+        dataset_train = unpack_dataset(dataset_train, NUM_PROC)
+        data_collator = partial(collate_padded, pad_token_id=pad_token_id)
+    else:
+        # The attention mask is built in the dtype the model computes in
+        dtype = torch.bfloat16 if is_bfloat16_supported() else torch.float16
+        # Packed examples must not attend to each other; unsloth's training forward drops the attention mask
+        data_collator = select_packed_collator(model, pad_token_id, dtype, len(tokenizer))
+        if data_collator is None:
+            raise RuntimeError("The model lets packed examples attend to each other with both the block-diagonal "
+                               "attention mask and position_ids (which need flash-attention varlen support); "
+                               "rerun with --unpacked to train on one example per row instead")
+        print_packing_report(packing_report)
+
+    # Each step sees effective_batch_size packed sequences, or examples when unpacked
+    total_samples = len(dataset_train)
     per_device_train_batch_size =4
     gradient_accumulation_steps=8
     num_train_epochs=4
     effective_batch_size = per_device_train_batch_size * gradient_accumulation_steps
-    total_steps = (total_samples*num_train_epochs) // effective_batch_size
+    total_steps = math.ceil(total_samples / effective_batch_size) * num_train_epochs
 
     warmup_steps = int(0.1 * total_steps)
 
@@ -82,10 +173,12 @@ def main():
         model=model,
         tokenizer=tokenizer,
         train_dataset=dataset_train,
-        dataset_text_field="text",
         max_seq_length=max_seq_length,
-        dataset_num_proc=1,
-        packing=True,
+        # The dataset is already tokenized and packed by build_tokenized_dataset; dataset_text_field
+        # is unused but SFTTrainer requires it when packing is off
+        dataset_text_field="text",
+        dataset_kwargs={"skip_prepare_dataset": True},
+        data_collator=data_collator,
         args=TrainingArguments(
             learning_rate=3e-4,
             lr_scheduler_type="cosine",
@@ -98,6 +191,7 @@ def main():
             optim="adamw_hf",
             weight_decay=0.01,
             warmup_steps=warmup_steps,
+            group_by_length=args.unpacked,
             output_dir="output", 
             seed=0,
         ),